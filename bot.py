@@ -1,25 +1,2103 @@
+import abc
+import argparse
 import json
 import logging
+import multiprocessing
 import time
-from datetime import datetime, timedelta
+import bisect
+import functools
+import hashlib
+import heapq
+import itertools
+import math
+import re
+import shutil
+import sqlite3
+import string
+import sys
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+import zlib
+import threading
+import queue
+import random
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime
 import os
+import requests
 import vk_api
 from vk_api.longpoll import VkLongPoll, VkEventType
 from vk_api.utils import get_random_id
+from vk_api.vk_api import VkApiMethod
 import g4f
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format='%(asctime)s - %(levelname)s - %(message)s')
+if os.environ.get("LOG_FORMAT") == "json":
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(JsonFormatter())
 logger = logging.getLogger(__name__)
 
+class Metrics:
+    """Счётчики, гистограммы задержек по этапам и gauges с выводом в формате Prometheus."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def total(self, name):
+        with self.lock:
+            return sum(value for (counter, _), value in self.counters.items() if counter == name)
+
+    def quantile(self, stage, q):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if not histogram or not histogram[2]:
+                return None
+            rank, seen = q * histogram[2], 0
+            for bound, count in zip(self.BUCKETS + (float("inf"),), histogram[0]):
+                seen += count
+                if seen >= rank:
+                    return bound
+
+    @staticmethod
+    def _labels(labels):
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = {stage: (list(h[0]), h[1], h[2]) for stage, h in self.histograms.items()}
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE candyx_{name} counter")
+                typed.add(name)
+            lines.append(f"candyx_{name}{self._labels(labels)} {value}")
+        if histograms:
+            lines.append("# TYPE candyx_stage_seconds histogram")
+        for stage, (buckets, total, count) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.BUCKETS + ("+Inf",), buckets):
+                cumulative += bucket
+                lines.append(f'candyx_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'candyx_stage_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'candyx_stage_seconds_count{{stage="{stage}"}} {count}')
+        for name, func in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                logger.debug("Ошибка чтения метрики %s: %s", name, e)
+                continue
+            lines.append(f"# TYPE candyx_{name} gauge")
+            lines.append(f"candyx_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+def timed(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self.metrics.observe(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+class SamplingProfiler:
+    """Сэмплирующий профайлер: периодически снимает стеки всех потоков и считает строки кода бота."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = Counter()
+        self.total = 0
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return False
+        self.samples.clear()
+        self.total = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self, top=10):
+        if not self.running:
+            return None
+        self.running = False
+        self.thread.join()
+        return self.samples.most_common(top), self.total
+
+    def _run(self):
+        me = threading.get_ident()
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                while frame is not None and frame.f_code.co_filename != __file__:
+                    frame = frame.f_back
+                if frame is not None:
+                    self.samples[f"{frame.f_code.co_name}:{frame.f_lineno}"] += 1
+                    self.total += 1
+            time.sleep(self.interval)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class EventDispatcher:
+    """Обрабатывает события разных пользователей параллельно, сохраняя порядок для каждого."""
+
+    def __init__(self, handler, workers):
+        self.handler = handler
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatch")
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key, event):
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue is not None:
+                queue.append(event)
+                return
+            self.queues[key] = deque([event])
+        self.pool.submit(self._drain, key)
+
+    def _drain(self, key):
+        while True:
+            with self.lock:
+                queue = self.queues[key]
+                if not queue:
+                    del self.queues[key]
+                    return
+                event = queue.popleft()
+            try:
+                self.handler(event)
+            except Exception as e:
+                logger.error("Ошибка обработки события от %s: %s", key, e)
+
+    def pending(self):
+        with self.lock:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+def vk_execute_batch(session, calls):
+    with vk_api.VkRequestsPool(session) as pool:
+        results = [pool.method(method, params) for method, params in calls]
+    return [(result.ok, result.result if result.ok else result.error) for result in results]
+
+class SendQueue:
+    """Объединяет исходящие вызовы VK API в пакеты execute с ограничением частоты запросов."""
+
+    BATCH_SIZE = 25
+    RETRY_CODES = {6, 9, 10}
+
+    def __init__(self, session, rps, retries=3, backoff=0.5, metrics=None):
+        self.session = session
+        self.execute_batch = getattr(session, "execute_batch", None) or functools.partial(vk_execute_batch, session)
+        self.metrics = metrics or Metrics()
+        self.rps = rps
+        self.interval = 1.0 / rps
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue()
+        self.http_calls = 0
+        self.thread = threading.Thread(target=self._run, name="send-queue", daemon=True)
+        self.thread.start()
+
+    def call(self, method, params, wait=True, timeout=30):
+        future = Future()
+        self.queue.put((method, params, future, 0))
+        return future.result(timeout=timeout) if wait else future
+
+    def method(self, method, values=None):
+        return self.call(method, values or {})
+
+    def _run(self):
+        last = 0.0
+        while True:
+            batch = [self.queue.get()]
+            delay = self.interval - (time.monotonic() - last)
+            if delay > 0:
+                time.sleep(delay)
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            last = time.monotonic()
+            self._execute(batch)
+
+    def _retry(self, item, error):
+        method, params, future, attempt = item
+        if attempt >= self.retries:
+            future.set_exception(error)
+            return
+        timer = threading.Timer(self.backoff * 2 ** attempt, self.queue.put, args=((method, params, future, attempt + 1),))
+        timer.daemon = True
+        timer.start()
+
+    def _execute(self, batch):
+        self.http_calls += 1
+        self.metrics.inc("vk_http_requests_total")
+        for method, _, _, _ in batch:
+            self.metrics.inc("vk_api_calls_total", method=method)
+        try:
+            results = self.execute_batch([(method, params) for method, params, _, _ in batch])
+        except vk_api.exceptions.ApiError as e:
+            logger.warning("Ошибка execute (%s вызовов): %s", len(batch), e)
+            self.metrics.inc("vk_api_errors_total", method="execute", code=e.code)
+            for item in batch:
+                if e.code in self.RETRY_CODES:
+                    self._retry(item, e)
+                else:
+                    item[2].set_exception(e)
+            return
+        except Exception as e:
+            logger.error("Ошибка отправки пакета (%s вызовов): %s", len(batch), e)
+            for item in batch:
+                self._retry(item, e)
+            return
+        for item, (ok, result) in zip(batch, results):
+            if ok:
+                item[2].set_result(result)
+                continue
+            error = vk_api.exceptions.ApiError(self.session, item[0], item[1], None, result)
+            self.metrics.inc("vk_api_errors_total", method=item[0], code=error.code)
+            if error.code in self.RETRY_CODES:
+                self._retry(item, error)
+            else:
+                item[2].set_exception(error)
+
+class AnswerCache:
+    """LRU-кэш ответов ИИ по нормализованному вопросу с поиском похожих вопросов по n-граммам."""
+
+    def __init__(self, max_size=1000, ttl=86400, threshold=0.85, ngram=3):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.ngram = ngram
+        self.entries = OrderedDict()
+        self.index = {}
+        self.hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+        self.version = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text):
+        text = text.lower().replace('ё', 'е')
+        return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+    def vectorize(self, key):
+        padded = f" {key} "
+        vector = Counter(padded[i:i + self.ngram] for i in range(max(len(padded) - self.ngram + 1, 1)))
+        return vector, math.sqrt(sum(v * v for v in vector.values()))
+
+    def _remove(self, key):
+        _, _, vector, _ = self.entries.pop(key)
+        for gram in vector:
+            keys = self.index.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.index[gram]
+
+    @staticmethod
+    def numbers(key):
+        return re.findall(r"\d+", key)
+
+    def _similar(self, key, vector, norm):
+        numbers = self.numbers(key)
+        shared = Counter()
+        for gram in vector:
+            for other_key in self.index.get(gram, ()):
+                shared[other_key] += 1
+        best_key, best_score = None, 0.0
+        candidates = (key for key, _ in shared.most_common() if self.numbers(key) == numbers)
+        for key in itertools.islice(candidates, 10):
+            _, _, other, other_norm = self.entries[key]
+            dot = sum(count * other.get(gram, 0) for gram, count in vector.items())
+            score = dot / (norm * other_norm) if norm and other_norm else 0.0
+            if score > best_score:
+                best_key, best_score = key, score
+        return best_key if best_score >= self.threshold else None
+
+    def get(self, question):
+        key = self.normalize(question)
+        if not key:
+            return None
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            fuzzy = False
+            if entry is None and self.threshold < 1:
+                similar = self._similar(key, *self.vectorize(key))
+                if similar is not None:
+                    key, entry, fuzzy = similar, self.entries[similar], True
+            if entry is not None and entry[1] < now:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.fuzzy_hits += fuzzy
+            return entry[0]
+
+    def put(self, question, answer):
+        key = self.normalize(question)
+        if not key:
+            return
+        vector, norm = self.vectorize(key)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (answer, time.time() + self.ttl, vector, norm)
+            for gram in vector:
+                self.index.setdefault(gram, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, version):
+        with self.lock:
+            if version == self.version:
+                return
+            self.entries.clear()
+            self.index.clear()
+            self.version = version
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+class RulesIndex:
+    """Индекс пунктов правил для подстановки в промпт только релевантных разделов."""
+
+    SECTION = re.compile(r"^\s*(\d+(?:\.\d+)+|\d+(?=[.)]))[.)]?\s+(.*)$")
+    CITATION = re.compile(r"(?<![\d.])(\d+(?:\.\d+)+)(?![\d])|(?:пункт[а-я]*|п\.)\s*(\d+(?:\.\d+)*)", re.IGNORECASE)
+
+    def __init__(self):
+        self.state = (OrderedDict(), {}, {}, {})
+
+    @property
+    def sections(self):
+        return self.state[0]
+
+    @staticmethod
+    def tokenize(text):
+        words = re.findall(r"\w{3,}", text.lower().replace('ё', 'е'))
+        return Counter(word[:6] for word in words if not word.isdigit())
+
+    @classmethod
+    def parse(cls, text):
+        sections = OrderedDict()
+        current = None
+        for line in text.splitlines():
+            match = cls.SECTION.match(line)
+            if match:
+                current = match.group(1)
+                sections[current] = line.strip()
+            elif current is not None and line.strip():
+                sections[current] += "\n" + line.strip()
+        if not sections:
+            for i, paragraph in enumerate(p.strip() for p in text.split("\n\n") if p.strip()):
+                sections[f"¶{i + 1}"] = paragraph
+        return sections
+
+    def build(self, text):
+        sections = self.parse(text)
+        old_sections, old_tokens = self.state[0], self.state[1]
+        cached = {old_sections[number]: vector for number, vector in old_tokens.items() if number in old_sections}
+        tokens = {number: cached.get(body) or self.tokenize(body) for number, body in sections.items()}
+        postings = {}
+        for number, vector in tokens.items():
+            for token, count in vector.items():
+                postings.setdefault(token, {})[number] = count
+        total = len(tokens) or 1
+        idf = {token: math.log(1 + total / len(numbers)) for token, numbers in postings.items()}
+        self.state = (sections, tokens, postings, idf)
+        logger.info("Индекс правил построен: %s пунктов, %s без изменений", len(sections), len(cached))
+
+    def cited(self, query, sections=None):
+        sections = self.sections if sections is None else sections
+        found = []
+        for match in self.CITATION.finditer(query):
+            number = (match.group(1) or match.group(2)).rstrip('.')
+            if number in sections and number not in found:
+                found.append(number)
+            elif number not in sections:
+                found.extend(n for n in sections if n.startswith(number + ".") and n not in found)
+        return found
+
+    def search(self, query, top_k=4):
+        sections, _, postings, idfs = self.state
+        cited = self.cited(query, sections)
+        found = list(cited)
+        scores = Counter()
+        for token, count in self.tokenize(query).items():
+            idf = idfs.get(token)
+            if idf is None:
+                continue
+            for number, tf in postings[token].items():
+                scores[number] += idf * (1 + math.log(tf)) * count
+        for number, _ in scores.most_common():
+            if len(found) >= top_k:
+                break
+            if number not in found:
+                found.append(number)
+        return found[:max(top_k, len(cited))]
+
+    def render(self, numbers):
+        sections = self.sections
+        return "\n".join(sections[number] for number in numbers if number in sections)
+
+class StateStore(abc.ABC):
+    """Хранилище состояния бота: записи копятся в памяти и пишутся пакетами в фоновом потоке."""
+
+    DELETED = object()
+
+    def __init__(self, flush_interval=0.5):
+        self.flush_interval = flush_interval
+        self.pending = OrderedDict()
+        self.tasks = []
+        self.sequences = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="state-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, namespace, key, value):
+        with self.lock:
+            self.pending[(namespace, str(key))] = value
+        self.wakeup.set()
+
+    def delete(self, namespace, key):
+        self.put(namespace, key, self.DELETED)
+
+    def submit(self, task):
+        with self.lock:
+            self.tasks.append(task)
+        self.wakeup.set()
+
+    def get(self, namespace, key, default=None):
+        with self.lock:
+            value = self.pending.get((namespace, str(key)))
+        if value is self.DELETED:
+            return default
+        if value is not None:
+            return value
+        return self._get(namespace, str(key), default)
+
+    def load(self, namespace):
+        data = self._load(namespace)
+        with self.lock:
+            for (ns, key), value in self.pending.items():
+                if ns != namespace:
+                    continue
+                if value is self.DELETED:
+                    data.pop(key, None)
+                else:
+                    data[key] = value
+        return data
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, OrderedDict()
+            tasks, self.tasks = self.tasks, []
+        if batch:
+            try:
+                self._write(list(batch.items()))
+            except Exception as e:
+                logger.error("Ошибка записи состояния (%s записей): %s", len(batch), e)
+        for task in tasks:
+            try:
+                task()
+            except Exception as e:
+                logger.error("Ошибка фоновой задачи хранилища: %s", e)
+
+    def claim(self, namespace, key):
+        return True
+
+    def _update_sequence(self, name, update):
+        with self.lock:
+            value = self.sequences.get(name)
+            if value is None:
+                value = self._get("sequences", name, 0)
+            value = self.sequences[name] = update(value)
+            self.pending[("sequences", name)] = value
+        self.wakeup.set()
+        return value
+
+    def allocate(self, name, floor=0):
+        return self._update_sequence(name, lambda value: max(value, floor) + 1)
+
+    def increment(self, name, delta=1):
+        return self._update_sequence(name, lambda value: value + delta)
+
+    def counter(self, name):
+        with self.lock:
+            value = self.sequences.get(name)
+        return self._get("sequences", name, 0) if value is None else value
+
+    def count(self, namespace):
+        return len(self.load(namespace))
+
+    def first(self, namespace, limit):
+        data = self.load(namespace)
+        return [data[key] for key in sorted(data, key=int)[:limit]]
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self.closed:
+            self.wakeup.wait()
+            time.sleep(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    @abc.abstractmethod
+    def _get(self, namespace, key, default):
+        pass
+
+    @abc.abstractmethod
+    def _load(self, namespace):
+        pass
+
+    @abc.abstractmethod
+    def _write(self, batch):
+        pass
+
+class SqliteStateStore(StateStore):
+    def __init__(self, path, flush_interval=0.5):
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db_lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS state (namespace TEXT, key TEXT, value TEXT, PRIMARY KEY (namespace, key))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, origin INTEGER, kind TEXT, data TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sequences (name TEXT PRIMARY KEY, value INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS claims (namespace TEXT, key TEXT, created REAL, PRIMARY KEY (namespace, key))")
+        self.claims = 0
+        super().__init__(flush_interval)
+
+    def claim(self, namespace, key, ttl=86400):
+        now = time.time()
+        with self.db_lock:
+            claimed = self.db.execute("INSERT OR IGNORE INTO claims (namespace, key, created) VALUES (?, ?, ?)", (namespace, str(key), now)).rowcount == 1
+            self.claims += 1
+            if self.claims % 1000 == 0:
+                self.db.execute("DELETE FROM claims WHERE created < ?", (now - ttl,))
+        return claimed
+
+    def _update_sequence(self, name, expression, *args):
+        with self.db_lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute("INSERT OR IGNORE INTO sequences (name, value) VALUES (?, 0)", (name,))
+                self.db.execute(f"UPDATE sequences SET value = {expression} WHERE name = ?", (*args, name))
+                value = self.db.execute("SELECT value FROM sequences WHERE name = ?", (name,)).fetchone()[0]
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return value
+
+    def allocate(self, name, floor=0):
+        return self._update_sequence(name, "MAX(value, ?) + 1", floor)
+
+    def increment(self, name, delta=1):
+        return self._update_sequence(name, "value + ?", delta)
+
+    def counter(self, name):
+        with self.db_lock:
+            row = self.db.execute("SELECT value FROM sequences WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def _pending(self, namespace):
+        with self.lock:
+            return {key: value for (ns, key), value in self.pending.items() if ns == namespace}
+
+    def count(self, namespace):
+        pending = self._pending(namespace)
+        with self.db_lock:
+            total = self.db.execute("SELECT COUNT(*) FROM state WHERE namespace = ?", (namespace,)).fetchone()[0]
+            stored = {key for key in pending if self.db.execute("SELECT 1 FROM state WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()}
+        for key, value in pending.items():
+            if value is self.DELETED:
+                total -= key in stored
+            else:
+                total += key not in stored
+        return total
+
+    def first(self, namespace, limit):
+        pending = self._pending(namespace)
+        with self.db_lock:
+            rows = self.db.execute(
+                "SELECT key, value FROM state WHERE namespace = ? ORDER BY CAST(key AS INTEGER) LIMIT ?", (namespace, limit + len(pending))
+            ).fetchall()
+        data = {key: json.loads(value) for key, value in rows}
+        for key, value in pending.items():
+            if value is self.DELETED:
+                data.pop(key, None)
+            else:
+                data[key] = value
+        return [data[key] for key in sorted(data, key=int)[:limit]]
+
+    def publish(self, origin, kind, data):
+        with self.db_lock:
+            self.db.execute("INSERT INTO changes (origin, kind, data) VALUES (?, ?, ?)", (origin, kind, json.dumps(data, ensure_ascii=False)))
+
+    def changes(self, after):
+        with self.db_lock:
+            if after is None:
+                return self.db.execute("SELECT COALESCE(MAX(seq), 0), NULL, NULL, NULL FROM changes").fetchall()
+            rows = self.db.execute("SELECT seq, origin, kind, data FROM changes WHERE seq > ? ORDER BY seq", (after,)).fetchall()
+        return [(seq, origin, kind, json.loads(data)) for seq, origin, kind, data in rows]
+
+    def _get(self, namespace, key, default):
+        with self.db_lock:
+            row = self.db.execute("SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _load(self, namespace):
+        with self.db_lock:
+            rows = self.db.execute("SELECT key, value FROM state WHERE namespace = ?", (namespace,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def _write(self, batch):
+        upserts = [(ns, key, json.dumps(value, ensure_ascii=False)) for (ns, key), value in batch if value is not self.DELETED]
+        deletes = [(ns, key) for (ns, key), value in batch if value is self.DELETED]
+        with self.db_lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany("INSERT OR REPLACE INTO state (namespace, key, value) VALUES (?, ?, ?)", upserts)
+                self.db.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", deletes)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+class JournalStateStore(StateStore):
+    def __init__(self, path, flush_interval=0.5, snapshot_every=10000):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.snapshot_every = snapshot_every
+        self.data = {}
+        self.journal_size = 0
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.data = json.load(f)
+        if os.path.exists(self.journal_path):
+            good = 0
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("неполная запись")
+                        ns, key, value, deleted = json.loads(line)
+                    except ValueError:
+                        logger.warning("Журнал %s оборван на байте %s, хвост отброшен", self.journal_path, good)
+                        break
+                    self._apply(ns, key, value, deleted)
+                    self.journal_size += 1
+                    good += len(line)
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(good)
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        super().__init__(flush_interval)
+
+    def _apply(self, namespace, key, value, deleted):
+        if deleted:
+            self.data.get(namespace, {}).pop(key, None)
+        else:
+            self.data.setdefault(namespace, {})[key] = value
+
+    def _get(self, namespace, key, default):
+        return self.data.get(namespace, {}).get(key, default)
+
+    def _load(self, namespace):
+        return dict(self.data.get(namespace, {}))
+
+    def _write(self, batch):
+        lines = []
+        for (ns, key), value in batch:
+            deleted = value is self.DELETED
+            self._apply(ns, key, None if deleted else value, deleted)
+            lines.append(json.dumps([ns, key, None if deleted else value, deleted], ensure_ascii=False) + "\n")
+        self.journal.write("".join(lines))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal_size += len(lines)
+        if self.journal_size >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        atomic_write(self.path, json.dumps(self.data, ensure_ascii=False))
+        self.journal.close()
+        self.journal = open(self.journal_path, 'w', encoding='utf-8')
+        self.journal_size = 0
+
+class PersistentDict(dict):
+    """Словарь, зеркалирующий изменения в StateStore; lazy подгружает ключи при обращении."""
+
+    def __init__(self, store, namespace, key_type=int, encode=None, decode=None, lazy=False):
+        super().__init__()
+        self.store = store
+        self.namespace = namespace
+        self.key_type = key_type
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda value: value)
+        self.lazy = lazy
+        if not lazy:
+            for key, value in store.load(namespace).items():
+                super().__setitem__(key_type(key), self.decode(value))
+
+    def _fetch(self, key):
+        if self.lazy and not super().__contains__(key):
+            value = self.store.get(self.namespace, key)
+            if value is not None:
+                super().__setitem__(key, self.decode(value))
+
+    def __contains__(self, key):
+        self._fetch(key)
+        return super().__contains__(key)
+
+    def __getitem__(self, key):
+        self._fetch(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self._fetch(key)
+        return super().get(key, default)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.store.put(self.namespace, key, self.encode(value))
+
+    def __delitem__(self, key):
+        self._fetch(key)
+        super().__delitem__(key)
+        self.store.delete(self.namespace, key)
+
+    def pop(self, key, *default):
+        self._fetch(key)
+        if super().__contains__(key):
+            self.store.delete(self.namespace, key)
+        return super().pop(key, *default)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+class PersistentSet(set):
+    """Множество, зеркалирующее изменения в StateStore."""
+
+    def __init__(self, store, namespace, key_type=int):
+        super().__init__(key_type(key) for key in store.load(namespace))
+        self.store = store
+        self.namespace = namespace
+
+    def add(self, key):
+        if key not in self:
+            super().add(key)
+            self.store.put(self.namespace, key, 1)
+
+    def discard(self, key):
+        if key in self:
+            super().discard(key)
+            self.store.delete(self.namespace, key)
+
+class BanRegistry:
+    """Активные блокировки с O(1) проверкой и снятием по истечении через min-heap."""
+
+    MAX_HOURS = 24 * 365 * 10
+
+    def __init__(self, store, on_expire=None, on_change=None, owns=None):
+        self.store = store
+        self.on_expire = on_expire
+        self.on_change = on_change
+        self.owns = owns
+        self.bans = {int(uid): datetime.fromisoformat(expiry).timestamp() for uid, expiry in store.load("bans").items()}
+        self.heap = [(expiry, uid) for uid, expiry in self.bans.items()]
+        heapq.heapify(self.heap)
+        self.history = PersistentDict(store, "ban_history", lazy=True)
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="ban-expiry", daemon=True)
+        self.thread.start()
+
+    def __contains__(self, uid):
+        return self.is_banned(uid)
+
+    def __len__(self):
+        return len(self.bans)
+
+    def is_banned(self, uid):
+        expiry = self.bans.get(uid)
+        return expiry is not None and expiry > time.time()
+
+    def expiry(self, uid):
+        expiry = self.bans.get(uid)
+        return datetime.fromtimestamp(expiry) if expiry is not None else None
+
+    def ban(self, uid, hours, by=None):
+        if not 0 < hours <= self.MAX_HOURS:
+            raise ValueError(f"срок блокировки вне диапазона: {hours} ч")
+        now = time.time()
+        expiry = now + hours * 3600
+        until = datetime.fromtimestamp(expiry).isoformat()
+        with self.condition:
+            if self.is_banned(uid):
+                return False
+            self.bans[uid] = expiry
+            heapq.heappush(self.heap, (expiry, uid))
+            self.store.put("bans", uid, until)
+            self.history[uid] = self.records(uid) + [{"from": now, "until": expiry, "by": by}]
+            self.condition.notify()
+        if self.on_change:
+            self.on_change("ban", {"uid": uid, "expiry": expiry})
+        return True
+
+    def unban(self, uid, by=None):
+        with self.condition:
+            if not self.is_banned(uid):
+                return False
+            self._lift(uid, by)
+        if self.on_change:
+            self.on_change("unban", {"uid": uid})
+        return True
+
+    def apply_ban(self, uid, expiry):
+        with self.condition:
+            self.bans[uid] = expiry
+            heapq.heappush(self.heap, (expiry, uid))
+            self.condition.notify()
+
+    def apply_unban(self, uid):
+        with self.condition:
+            self.bans.pop(uid, None)
+
+    def records(self, uid):
+        if self.owns is None:
+            return self.history.get(uid, [])
+        return self.store.get("ban_history", uid, [])
+
+    def _lift(self, uid, by):
+        del self.bans[uid]
+        self.store.delete("bans", uid)
+        records = self.records(uid)
+        if records:
+            records[-1] = dict(records[-1], lifted=time.time(), lifted_by=by)
+            self.history[uid] = records
+
+    def expire(self):
+        expired = []
+        now = time.time()
+        with self.condition:
+            while self.heap and self.heap[0][0] <= now:
+                expiry, uid = heapq.heappop(self.heap)
+                if self.bans.get(uid) != expiry:
+                    continue
+                if self.owns is None or self.owns(uid):
+                    self._lift(uid, None)
+                    expired.append(uid)
+                else:
+                    del self.bans[uid]
+        return expired
+
+    def _run(self):
+        while True:
+            with self.condition:
+                timeout = self.heap[0][0] - time.time() if self.heap else None
+                if timeout is None or timeout > 0:
+                    self.condition.wait(timeout)
+            for uid in self.expire():
+                logger.info("Срок блокировки %s истёк", uid)
+                if self.on_expire:
+                    try:
+                        self.on_expire(uid)
+                    except Exception as e:
+                        logger.error("Ошибка уведомления о снятии блокировки %s: %s", uid, e)
+
+class UserSession:
+    """Компактное состояние пользователя: лимиты, контекст ИИ и кэш разрешений."""
+
+    __slots__ = ("last_seen", "buckets", "strikes", "strike_at", "mutes", "muted_until", "context", "allowed", "allowed_at")
+
+    def __init__(self, context):
+        self.last_seen = time.time()
+        self.buckets = {}
+        self.strikes = 0
+        self.strike_at = 0.0
+        self.mutes = 0
+        self.muted_until = 0.0
+        self.context = context
+        self.allowed = None
+        self.allowed_at = 0.0
+
+class SessionStore:
+    """LRU-хранилище сессий с вытеснением по размеру и времени простоя."""
+
+    def __init__(self, store, max_size=100000, idle_ttl=3600):
+        self.store = store
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, user):
+        now = time.time()
+        with self.lock:
+            session = self.sessions.get(user)
+            if session is not None:
+                self.sessions.move_to_end(user)
+                session.last_seen = now
+                return session
+        session = UserSession(self.store.get("contexts", user, []))
+        mute = self.store.get("mutes", user)
+        if mute:
+            session.mutes, session.muted_until = mute["mutes"], mute["until"]
+        with self.lock:
+            session = self.sessions.setdefault(user, session)
+            self.store.put("users", user, int(now))
+            self.created += 1
+            self._evict(now)
+        return session
+
+    def _evict(self, now):
+        while self.sessions:
+            user, session = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_size and now - session.last_seen < self.idle_ttl:
+                break
+            del self.sessions[user]
+            self.evicted += 1
+
+class RateLimiter:
+    """Token bucket лимиты по пользователю и действию, глобальные лимиты и нарастающие муты."""
+
+    DEFAULTS = {
+        "policies": {
+            "message": {"capacity": 25, "per": 60},
+            "ai": {"capacity": 10, "per": 60},
+            "report": {"capacity": 3, "per": 600},
+            "operator": {"capacity": 20, "per": 60},
+            "admin": {"capacity": 30, "per": 60}
+        },
+        "global": {
+            "ai": {"capacity": 60, "per": 60}
+        },
+        "mute": {"strikes": 5, "window": 300, "base": 60, "max": 86400}
+    }
+
+    def __init__(self, config=None):
+        self.lock = threading.Lock()
+        self.configure(config or self.DEFAULTS)
+
+    @staticmethod
+    def _rates(policies):
+        return {name: (float(p["capacity"]), float(p["capacity"]) / float(p["per"])) for name, p in policies.items()}
+
+    def configure(self, config):
+        policies = self._rates(dict(self.DEFAULTS["policies"], **config.get("policies", {})))
+        global_policies = self._rates(dict(self.DEFAULTS["global"], **config.get("global", {})))
+        mute = dict(self.DEFAULTS["mute"], **config.get("mute", {}))
+        with self.lock:
+            self.policies = policies
+            self.global_policies = global_policies
+            self.global_buckets = {name: [capacity, time.monotonic()] for name, (capacity, _) in global_policies.items()}
+            self.mute = mute
+
+    @staticmethod
+    def _take(bucket, capacity, rate, now):
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def muted(self, session):
+        remaining = session.muted_until - time.time()
+        return remaining if remaining > 0 else 0
+
+    def allow(self, session, policy):
+        capacity, rate = self.policies[policy]
+        now = time.monotonic()
+        bucket = session.buckets.get(policy)
+        if bucket is None:
+            bucket = session.buckets[policy] = [capacity, now]
+        return self._take(bucket, capacity, rate, now)
+
+    def allow_global(self, policy):
+        if policy not in self.global_policies:
+            return True
+        capacity, rate = self.global_policies[policy]
+        with self.lock:
+            return self._take(self.global_buckets[policy], capacity, rate, time.monotonic())
+
+    def penalize(self, session):
+        now = time.time()
+        if now - session.strike_at > self.mute["window"]:
+            session.strikes = 0
+        session.strikes += 1
+        session.strike_at = now
+        if session.strikes < self.mute["strikes"]:
+            return 0
+        duration = min(self.mute["base"] * 2 ** session.mutes, self.mute["max"])
+        session.mutes += 1
+        session.strikes = 0
+        session.muted_until = now + duration
+        return duration
+
+class HyperLogLog:
+    """Приблизительный счётчик уникальных значений (HyperLogLog, 2**p регистров)."""
+
+    def __init__(self, p=12, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers else bytearray(self.m)
+        self.alpha = 0.7213 / (1 + 1.079 / self.m)
+
+    def add(self, value):
+        x = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+        index = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def merge(self, registers):
+        for i, rank in enumerate(registers):
+            if rank > self.registers[i]:
+                self.registers[i] = rank
+
+    def __len__(self):
+        estimate = self.alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+class BroadcastJobs:
+    """Фоновые рассылки пачками по peer_ids с сохранением прогресса для продолжения после перезапуска."""
+
+    PEERS_PER_CALL = 100
+    PROGRESS_INTERVAL = 30
+
+    def __init__(self, store, outbox, notify, on_sent=None):
+        self.store = store
+        self.outbox = outbox
+        self.notify = notify
+        self.on_sent = on_sent
+        self.threads = {}
+
+    def start(self, text, recipients, admin, segment):
+        job_id = str(int(time.time() * 1000))
+        job = {"text": text, "admin": admin, "segment": segment, "total": len(recipients), "offset": 0, "sent": 0, "failed": 0, "status": "running"}
+        self.store.put("broadcast_recipients", job_id, recipients)
+        self.store.put("broadcasts", job_id, job)
+        self._spawn(job_id, job, recipients)
+        return job_id
+
+    def resume(self):
+        for job_id, job in self.store.load("broadcasts").items():
+            if job.get("status") == "running":
+                logger.info("Продолжение рассылки #%s с позиции %s/%s", job_id, job['offset'], job['total'])
+                self._spawn(job_id, job, self.store.get("broadcast_recipients", job_id, []))
+
+    def running(self):
+        return [job_id for job_id, thread in self.threads.items() if thread.is_alive()]
+
+    def _spawn(self, job_id, job, recipients):
+        thread = threading.Thread(target=self._run, args=(job_id, job, recipients), name=f"broadcast-{job_id}", daemon=True)
+        self.threads[job_id] = thread
+        thread.start()
+
+    def _send(self, job_id, job, chunk, offset):
+        params = {
+            "peer_ids": ",".join(map(str, chunk)),
+            "message": f"📢 ОПОВЕЩЕНИЕ:\n{job['text']}",
+            "random_id": zlib.crc32(f"{job_id}:{offset}".encode()) & 0x7fffffff
+        }
+        return self.outbox.call("messages.send", params, wait=False)
+
+    def _run(self, job_id, job, recipients):
+        last_report = time.monotonic()
+        while job["offset"] < len(recipients):
+            window = []
+            offset = job["offset"]
+            while len(window) < self.outbox.BATCH_SIZE and offset < len(recipients):
+                chunk = recipients[offset:offset + self.PEERS_PER_CALL]
+                window.append((chunk, self._send(job_id, job, chunk, offset)))
+                offset += len(chunk)
+            for chunk, future in window:
+                try:
+                    results = future.result(timeout=300)
+                    if self.on_sent:
+                        self.on_sent(results)
+                    sent = sum(1 for result in results if isinstance(result, dict) and "message_id" in result)
+                    job["sent"] += sent
+                    job["failed"] += len(chunk) - sent
+                except Exception as e:
+                    logger.error("Ошибка рассылки #%s для %s получателей: %s", job_id, len(chunk), e)
+                    job["failed"] += len(chunk)
+            job["offset"] = offset
+            self.store.put("broadcasts", job_id, job)
+            if time.monotonic() - last_report >= self.PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                self.notify(f"📢 Рассылка #{job_id}: {job['offset']}/{job['total']}, доставлено {job['sent']}, ошибок {job['failed']}.")
+        job["status"] = "done"
+        self.store.put("broadcasts", job_id, job)
+        self.store.delete("broadcast_recipients", job_id)
+        self.notify(f"📢 Рассылка #{job_id} завершена: доставлено {job['sent']} из {job['total']}, ошибок {job['failed']}.")
+
+def snapshot_event(event):
+    return SimpleNamespace(
+        type=event.type,
+        from_chat=getattr(event, 'from_chat', False),
+        to_me=getattr(event, 'to_me', False),
+        from_me=getattr(event, 'from_me', False),
+        user_id=getattr(event, 'user_id', None),
+        peer_id=getattr(event, 'peer_id', None),
+        message_id=getattr(event, 'message_id', None),
+        text=getattr(event, 'text', ""),
+        payload=getattr(event, 'payload', None),
+        attachments=getattr(event, 'attachments', None),
+        admin_author=getattr(event, 'admin_author', None)
+    )
+
+def run_shard(token, admin_chat, group, shard, shards, events, offline=False):
+    if offline:
+        bot = SupportBot(None, admin_chat, group, shard, shards, vk_session=OfflineVk(), ai_backend=offline_ai)
+        bot.outbox.interval = 0
+        bot.lift_limits()
+    else:
+        bot = SupportBot(token, admin_chat, group, shard, shards)
+    bot.serve_shard(events)
+
+class EventRecorder:
+    """Пишет входящие события в JSONL для последующего воспроизведения."""
+
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def write(self, event):
+        data = vars(snapshot_event(event))
+        data["type"] = getattr(data["type"], "name", data["type"])
+        data["t"] = round(time.monotonic() - self.started, 3)
+        line = json.dumps(data, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def replay_events(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            data.pop("t", None)
+            data["type"] = VkEventType[data["type"]]
+            yield SimpleNamespace(**data)
+
+def synthetic_events(count, users=1000, seed=0, agent=1):
+    rng = random.Random(seed)
+    buttons = ["ai_agent", "report_bug", "report_staff", "contact_agent", "cancel", "version"]
+    questions = ["Как получить разбан?", "Что за пункт 3.1?", "Не работает донат", "Можно ли играть с читами?", "Как сменить ник?"]
+    reports = ["Игрок использует читы на сервере", "Не открывается меню магазина", "Модератор оскорбляет игроков"]
+    def event(user, text="", payload=None):
+        return SimpleNamespace(
+            type=VkEventType.MESSAGE_NEW, from_chat=False, to_me=True, from_me=False, user_id=user,
+            peer_id=user, message_id=None, text=text, payload=payload, attachments=None
+        )
+    produced = 0
+    while produced < count:
+        kind = rng.random()
+        if kind < 0.05:
+            batch = [event(agent, "/stats")]
+        elif kind < 0.1:
+            target = rng.randint(1, users) + agent
+            batch = [event(agent, payload=json.dumps({"command": "ban"})), event(agent, f"{target} 1"), event(agent, payload=json.dumps({"command": "unban"})), event(agent, str(target))]
+        else:
+            user = rng.randint(1, users) + agent
+            command = rng.choice(buttons)
+            batch = [event(user, "Начать"), event(user, payload=json.dumps({"command": command}))]
+            if command == "ai_agent":
+                batch += [event(user, rng.choice(questions)) for _ in range(rng.randint(1, 3))] + [event(user, "выйти")]
+            elif command.startswith("report"):
+                batch.append(event(user, rng.choice(reports)))
+            elif command == "contact_agent":
+                batch += [event(user, rng.choice(questions)), event(user, payload=json.dumps({"command": "end_human"}))]
+        for item in batch[:count - produced]:
+            yield item
+        produced += len(batch)
+
+def offline_ai(name, messages, stream=False, delay=0.05, chunk_delay=0.0):
+    time.sleep(delay)
+    answer = f"Пункт 1.1: уточните детали по вопросу «{messages[-1]['content'][:60]}» или обратитесь к агенту."
+    chunks = answer.split(" ")[:1] + [" " + word for word in answer.split(" ")[1:]]
+    if not stream:
+        time.sleep(chunk_delay * len(chunks))
+        return answer
+
+    def generate():
+        for chunk in chunks:
+            time.sleep(chunk_delay)
+            yield chunk
+    return generate()
+
+class OfflineVk:
+    """Заглушка VK API для воспроизведения и замеров: отвечает правдоподобно и считает вызовы."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = Counter()
+        self.message_id = 0
+        self.lock = threading.Lock()
+
+    def method(self, method, values=None):
+        values = values or {}
+        with self.lock:
+            self.calls[method] += 1
+            if method == "messages.send":
+                self.message_id += 1
+                message_id = self.message_id
+        if method == "messages.send":
+            if "peer_ids" in values:
+                return [{"peer_id": int(peer), "message_id": message_id} for peer in str(values["peer_ids"]).split(",")]
+            return message_id
+        if method == "messages.isMessagesFromGroupAllowed":
+            return {"is_allowed": 1}
+        if method == "users.get":
+            return [{"id": int(user), "first_name": "Пользователь", "last_name": str(user)} for user in str(values.get("user_ids", "")).split(",") if user]
+        return 1
+
+    def execute_batch(self, calls):
+        if self.delay:
+            time.sleep(self.delay)
+        return [(True, self.method(method, params)) for method, params in calls]
+
+class CallbackServer(ThreadingHTTPServer):
+    """HTTP-приёмник Callback API: проверяет секрет, отбрасывает повторы и сразу отвечает "ok"."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, bot, confirmation, secret=None, dedupe_size=10000):
+        super().__init__(address, CallbackHandler)
+        self.bot = bot
+        self.confirmation = confirmation
+        self.secret = secret
+        self.dedupe_size = dedupe_size
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    def is_duplicate(self, event_id):
+        if not event_id:
+            return False
+        with self.lock:
+            if event_id in self.seen:
+                return True
+            self.seen[event_id] = True
+            if len(self.seen) > self.dedupe_size:
+                self.seen.popitem(last=False)
+        return not self.bot.store.claim("callback_events", event_id)
+
+    @staticmethod
+    def to_event(body):
+        message = body.get("object", {}).get("message", body.get("object", {}))
+        peer_id = message.get("peer_id", message.get("from_id", 0))
+        return SimpleNamespace(
+            type=VkEventType.MESSAGE_NEW,
+            from_chat=peer_id > 2000000000,
+            to_me=body.get("type") == "message_new",
+            from_me=body.get("type") == "message_reply",
+            user_id=message.get("from_id") if body.get("type") == "message_new" else peer_id,
+            peer_id=peer_id,
+            message_id=message.get("id"),
+            text=message.get("text", ""),
+            payload=message.get("payload"),
+            attachments=message.get("attachments") or None,
+            admin_author=message.get("admin_author_id") or 0 if body.get("type") == "message_reply" else None
+        )
+
+class CallbackHandler(BaseHTTPRequestHandler):
+    def reply(self, code, text):
+        data = text.encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError:
+            self.reply(400, "bad request")
+            return
+        if not isinstance(body, dict):
+            self.reply(400, "bad request")
+            return
+        if body.get("group_id") != server.bot.group or (server.secret and body.get("secret") != server.secret):
+            logger.warning("Отклонён запрос Callback API: %s от %s", body.get('type'), self.client_address[0])
+            self.reply(403, "forbidden")
+            return
+        if body.get("type") == "confirmation":
+            self.reply(200, server.confirmation)
+            return
+        if body.get("type") in ("message_new", "message_reply") and not server.is_duplicate(body.get("event_id")):
+            event = server.to_event(body)
+            server.bot.ingest(event)
+        self.reply(200, "ok")
+
+    def log_message(self, format, *args):
+        logger.debug("Callback API: " + format, *args)
+
+class TicketQueue:
+    """Обращения к операторам: индексированная очередь, назначение по роли и загрузке, SLA-метрики."""
+
+    ROLES = ("agent", "admin", "manager")
+    EMPTY_SLA = {"responses": 0, "response_time": 0.0, "resolved": 0, "resolution_time": 0.0}
+
+    def __init__(self, store, agents, sla_key="tickets", shared=False, owns=None):
+        self.store = store
+        self.agents = agents
+        self.sla_key = sla_key
+        self.shared = shared
+        self.owns = owns or (lambda user: True)
+        self.lock = threading.Lock()
+        self.tickets = {}
+        self.by_user = {}
+        self.waiting = []
+        self.load = Counter()
+        self.floor = store.get("stats", "ticket_seq", 0)
+        for ticket in store.load("tickets").values():
+            self.floor = max(self.floor, ticket["id"])
+            if self.owns(ticket["user"]):
+                self._index(ticket)
+        self.sla = store.get("stats", sla_key, dict(self.EMPTY_SLA))
+
+    def _index(self, ticket):
+        self.tickets[ticket["id"]] = ticket
+        self.by_user[ticket["user"]] = ticket["id"]
+        if ticket["first_response"] is None:
+            bisect.insort(self.waiting, ticket["id"])
+        if ticket["assignee"]:
+            self.load[ticket["assignee"]] += 1
+
+    def assigned(self, uid):
+        return self.store.counter(f"ticket_load:{uid}") if self.shared else self.load[uid]
+
+    def _assign(self):
+        agents = self.agents()
+        for role in self.ROLES:
+            candidates = [uid for uid, info in agents.items() if info.get("role") == role]
+            if candidates:
+                return min(candidates, key=lambda uid: (self.assigned(uid), uid))
+        return None
+
+    def get(self, user):
+        ticket_id = self.by_user.get(user)
+        return self.tickets.get(ticket_id) if ticket_id else None
+
+    def open(self, user):
+        with self.lock:
+            ticket = self.get(user)
+            if ticket is not None:
+                return ticket, False
+            ticket = {"id": self.store.allocate("tickets", self.floor), "user": user, "assignee": self._assign(), "created": time.time(), "first_response": None, "messages": 0}
+            self._index(ticket)
+            self.store.put("tickets", ticket["id"], ticket)
+            if self.shared:
+                self.store.put("ticket_users", user, ticket["id"])
+                if ticket["assignee"]:
+                    self.store.increment(f"ticket_load:{ticket['assignee']}")
+            return ticket, True
+
+    def follow_up(self, user):
+        with self.lock:
+            ticket = self.get(user)
+            if ticket is not None:
+                ticket["messages"] += 1
+                self.store.put("tickets", ticket["id"], ticket)
+            return ticket
+
+    def position(self, ticket):
+        with self.lock:
+            index = bisect.bisect_left(self.waiting, ticket["id"])
+            return index + 1 if index < len(self.waiting) and self.waiting[index] == ticket["id"] else 0
+
+    def respond(self, user):
+        with self.lock:
+            ticket = self.get(user)
+            if ticket is None or ticket["first_response"] is not None:
+                return None
+            ticket["first_response"] = time.time()
+            del self.waiting[bisect.bisect_left(self.waiting, ticket["id"])]
+            self.sla["responses"] += 1
+            self.sla["response_time"] += ticket["first_response"] - ticket["created"]
+            self.store.put("tickets", ticket["id"], ticket)
+            self.store.put("stats", self.sla_key, self.sla)
+            return ticket
+
+    def close(self, user):
+        with self.lock:
+            ticket = self.get(user)
+            if ticket is None:
+                return None
+            del self.tickets[ticket["id"]]
+            del self.by_user[user]
+            if ticket["first_response"] is None:
+                del self.waiting[bisect.bisect_left(self.waiting, ticket["id"])]
+            if ticket["assignee"]:
+                self.load[ticket["assignee"]] -= 1
+            self.sla["resolved"] += 1
+            self.sla["resolution_time"] += time.time() - ticket["created"]
+            self.store.delete("tickets", ticket["id"])
+            self.store.put("stats", self.sla_key, self.sla)
+            if self.shared:
+                self.store.delete("ticket_users", user)
+                if ticket["assignee"]:
+                    self.store.increment(f"ticket_load:{ticket['assignee']}", -1)
+            return ticket
+
+    def find(self, user):
+        if not self.shared:
+            return self.get(user)
+        ticket_id = self.store.get("ticket_users", user)
+        return self.store.get("tickets", ticket_id) if ticket_id is not None else None
+
+    def snapshot(self, limit=20):
+        if not self.shared:
+            with self.lock:
+                tickets = [self.tickets[ticket_id] for ticket_id in sorted(self.tickets)[:limit]]
+                return tickets, len(self.tickets), dict(self.sla)
+        sla = dict(self.EMPTY_SLA)
+        for key, value in self.store.load("stats").items():
+            if key.split(":")[0] == "tickets":
+                for field in sla:
+                    sla[field] += value.get(field, 0)
+        return self.store.first("tickets", limit), self.store.count("tickets"), sla
+
+class ProviderPool:
+    """Пул провайдеров ИИ: учёт задержек, circuit breaker и хеджированный повторный запрос."""
+
+    def __init__(self, names, call, metrics, workers=8, timeout=10, hedge_quantile=0.9, failure_threshold=3, cooldown=30):
+        self.names = list(names)
+        self.call = call
+        self.metrics = metrics
+        self.timeout = timeout
+        self.hedge_quantile = hedge_quantile
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.latencies = {name: deque(maxlen=100) for name in self.names}
+        self.failures = Counter()
+        self.opened = {}
+        self.probing = set()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ai-provider")
+
+    def quantile(self, name, q):
+        samples = sorted(self.latencies[name])
+        return samples[min(int(q * len(samples)), len(samples) - 1)] if samples else None
+
+    def state(self, name):
+        opened = self.opened.get(name)
+        if opened is None:
+            return "closed"
+        return "half_open" if time.monotonic() - opened >= self.cooldown else "open"
+
+    def ranked(self):
+        with self.lock:
+            available = []
+            for name in self.names:
+                state = self.state(name)
+                if state == "open" or (state == "half_open" and name in self.probing):
+                    continue
+                available.append(name)
+            available.sort(key=lambda name: (self.state(name) != "closed", self.quantile(name, 0.5) or 0))
+            return available
+
+    def _start(self, name):
+        with self.lock:
+            if self.state(name) == "half_open":
+                self.probing.add(name)
+
+    def record(self, name, latency, ok):
+        with self.lock:
+            self.probing.discard(name)
+            if ok:
+                self.latencies[name].append(latency)
+                self.failures[name] = 0
+                if self.opened.pop(name, None) is not None:
+                    logger.info("Провайдер ИИ %s снова доступен", name)
+            else:
+                self.failures[name] += 1
+                if self.failures[name] >= self.failure_threshold or name in self.opened:
+                    self.opened[name] = time.monotonic()
+                    logger.warning("Провайдер ИИ %s отключён на %s с", name, self.cooldown)
+        self.metrics.inc("ai_provider_requests_total", provider=name, result="ok" if ok else "error")
+        if ok:
+            self.metrics.observe(f"ai_provider_{name}", latency)
+
+    def _run(self, name, messages):
+        start = time.monotonic()
+        try:
+            response = self.call(name, messages)
+            if not isinstance(response, str) or not response.strip():
+                raise ValueError("пустой ответ")
+        except Exception as e:
+            self.record(name, time.monotonic() - start, False)
+            logger.warning("Ошибка провайдера ИИ %s: %s", name, e)
+            raise
+        self.record(name, time.monotonic() - start, True)
+        return response
+
+    def hedge_delay(self, name):
+        hedge = self.quantile(name, self.hedge_quantile)
+        return min(hedge, self.timeout / 2) if hedge is not None and len(self.latencies[name]) >= 5 else self.timeout / 2
+
+    def backup(self, primary):
+        backup = next((name for name in self.ranked() if name != primary), None) or primary
+        self.metrics.inc("ai_hedged_total", provider=backup)
+        self._start(backup)
+        return backup
+
+    def complete(self, messages):
+        names = self.ranked()
+        if not names:
+            return None
+        deadline = time.monotonic() + self.timeout
+        self._start(names[0])
+        pending = {self.pool.submit(self._run, names[0], messages)}
+        hedge_delay = self.hedge_delay(names[0])
+        hedged = False
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining if hedged else min(remaining, hedge_delay), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+            if not hedged and (not done or not pending):
+                hedged = True
+                backup = next((name for name in self.ranked() if name != names[0]), None)
+                if backup is None and not done:
+                    continue
+                backup = backup or names[0]
+                self.metrics.inc("ai_hedged_total", provider=backup)
+                self._start(backup)
+                pending.add(self.pool.submit(self._run, backup, messages))
+        if pending:
+            self.metrics.inc("ai_errors_total", kind="timeout")
+        return None
+
+    def _stream(self, name, messages, chunks, cancelled):
+        start = time.monotonic()
+        first = None
+        try:
+            for chunk in self.call(name, messages, stream=True):
+                if not isinstance(chunk, str) or not chunk:
+                    continue
+                if first is None:
+                    first = time.monotonic() - start
+                if cancelled.is_set():
+                    break
+                chunks.put((name, chunk))
+        except Exception as e:
+            logger.warning("Ошибка потока провайдера ИИ %s: %s", name, e)
+        self.record(name, first if first is not None else time.monotonic() - start, first is not None)
+        chunks.put((name, None))
+
+    def stream(self, messages):
+        names = self.ranked()
+        if not names:
+            return
+        chunks = queue.Queue()
+        cancelled = threading.Event()
+        deadline = time.monotonic() + self.timeout
+        self._start(names[0])
+        self.pool.submit(self._stream, names[0], messages, chunks, cancelled)
+        attempts, finished = 1, 0
+        hedge_delay = self.hedge_delay(names[0])
+        winner = None
+        try:
+            while True:
+                if winner is None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.metrics.inc("ai_errors_total", kind="timeout")
+                        return
+                    timeout = min(remaining, hedge_delay) if attempts == 1 else remaining
+                else:
+                    timeout = self.timeout
+                try:
+                    name, chunk = chunks.get(timeout=timeout)
+                except queue.Empty:
+                    if winner is not None:
+                        logger.warning("Поток провайдера ИИ %s остановился", winner)
+                        return
+                    if attempts == 1:
+                        attempts += 1
+                        self.pool.submit(self._stream, self.backup(names[0]), messages, chunks, cancelled)
+                    continue
+                if winner is not None and name != winner:
+                    continue
+                if chunk is None:
+                    finished += 1
+                    if winner is not None:
+                        return
+                    if attempts == 1:
+                        attempts += 1
+                        self.pool.submit(self._stream, self.backup(names[0]), messages, chunks, cancelled)
+                    elif finished >= attempts:
+                        return
+                    continue
+                winner = name
+                yield chunk
+        finally:
+            cancelled.set()
+
+    def report(self):
+        lines = []
+        for name in self.names:
+            p50, p99 = self.quantile(name, 0.5), self.quantile(name, 0.99)
+            latency = f"{p50 * 1000:.0f}/{p99 * 1000:.0f} мс" if p50 is not None else "нет данных"
+            lines.append(f"{name}: {latency}, {self.state(name)}")
+        return "\n".join(lines)
+
+class AttachmentPipeline:
+    """Скачивает вложения обращений в фоне и перезаливает их в админ-чат с дедупликацией по содержимому."""
+
+    MAX_SIZE = 50 * 1024 * 1024
+    CHUNK_SIZE = 64 * 1024
+    PHOTO_BATCH = 5
+    CACHE_SIZE = 5000
+    TIMEOUT = 30
+
+    def __init__(self, api, upload, peer_id, store, metrics, http=None, workers=4):
+        self.api = api
+        self.upload = upload
+        self.peer_id = peer_id
+        self.store = store
+        self.metrics = metrics
+        self.http = http or requests.Session()
+        self.jobs = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="attach")
+        self.downloads = ThreadPoolExecutor(max_workers=workers * 2, thread_name_prefix="download")
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, attachments, message_id=None):
+        return self.jobs.submit(self._forward, attachments, message_id)
+
+    @staticmethod
+    def reference(att):
+        obj = att.get(att.get('type'))
+        if not isinstance(obj, dict) or 'owner_id' not in obj:
+            return None
+        ref = f"{att['type']}{obj['owner_id']}_{obj['id']}"
+        return f"{ref}_{obj['access_key']}" if obj.get('access_key') else ref
+
+    @staticmethod
+    def source(att):
+        obj = att.get(att.get('type')) or {}
+        if att['type'] == "photo":
+            sizes = obj.get('sizes') or []
+            best = max(sizes, key=lambda size: size.get('width', 0) * size.get('height', 0), default=None)
+            return (best or {}).get('url') or obj.get('orig_photo', {}).get('url'), "jpg", None
+        if att['type'] == "doc":
+            return obj.get('url'), obj.get('ext') or "bin", obj.get('size')
+        return None, None, None
+
+    def cached(self, digest):
+        with self.lock:
+            if digest in self.cache:
+                self.cache.move_to_end(digest)
+                return self.cache[digest]
+        value = self.store.get("attachments", digest)
+        if value:
+            self.remember(digest, value)
+        return value
+
+    def remember(self, digest, value):
+        with self.lock:
+            self.cache[digest] = value
+            self.cache.move_to_end(digest)
+            while len(self.cache) > self.CACHE_SIZE:
+                self.cache.popitem(last=False)
+        self.store.put("attachments", digest, value)
+
+    def _resolve(self, attachments, message_id):
+        if isinstance(attachments, list):
+            return attachments
+        if not message_id:
+            return []
+        items = self.api("messages.getById", message_ids=message_id).get('items') or []
+        return items[0].get('attachments', []) if items else []
+
+    def _download(self, url, ext, size):
+        if size and size > self.MAX_SIZE:
+            raise ValueError(f"файл {size} байт превышает лимит")
+        digest = hashlib.sha256()
+        file = tempfile.NamedTemporaryFile(suffix=f".{ext}")
+        try:
+            with self.http.get(url, stream=True, timeout=self.TIMEOUT) as response:
+                response.raise_for_status()
+                if int(response.headers.get('Content-Length') or 0) > self.MAX_SIZE:
+                    raise ValueError("Content-Length превышает лимит")
+                total = 0
+                for chunk in response.iter_content(self.CHUNK_SIZE):
+                    total += len(chunk)
+                    if total > self.MAX_SIZE:
+                        raise ValueError("размер превышает лимит")
+                    digest.update(chunk)
+                    file.write(chunk)
+            file.flush()
+            file.seek(0)
+            self.metrics.inc("attachment_bytes_total", total)
+            return digest.hexdigest(), file
+        except Exception:
+            file.close()
+            raise
+
+    def _forward(self, attachments, message_id):
+        start = time.perf_counter()
+        try:
+            attachments = self._resolve(attachments, message_id)
+        except Exception as e:
+            logger.error("Не удалось получить вложения сообщения %s: %s", message_id, e)
+            return None
+        results = [self.reference(att) for att in attachments]
+        pending = []
+        for index, att in enumerate(attachments):
+            url, ext, size = self.source(att)
+            if url and self.upload:
+                pending.append((index, att['type'], self.downloads.submit(self._download, url, ext, size)))
+            else:
+                self.metrics.inc("attachments_total", result="reference")
+        photos, files, repeats, seen = [], [], [], set()
+        try:
+            for index, kind, future in pending:
+                try:
+                    digest, file = future.result()
+                except Exception as e:
+                    logger.warning("Вложение %s не скачано, пересылаю ссылкой: %s", index, e)
+                    self.metrics.inc("attachments_total", result="failed")
+                    continue
+                files.append(file)
+                cached = self.cached(digest)
+                if cached:
+                    results[index] = cached
+                    self.metrics.inc("attachments_total", result="cached")
+                elif digest in seen:
+                    repeats.append((index, digest))
+                elif kind == "photo":
+                    photos.append((index, digest, file))
+                else:
+                    self._upload_doc(results, index, digest, file, attachments[index]['doc'].get('title'))
+                seen.add(digest)
+            for offset in range(0, len(photos), self.PHOTO_BATCH):
+                self._upload_photos(results, photos[offset:offset + self.PHOTO_BATCH])
+            for index, digest in repeats:
+                uploaded = self.cached(digest)
+                if uploaded:
+                    results[index] = uploaded
+                self.metrics.inc("attachments_total", result="cached" if uploaded else "failed")
+        finally:
+            for file in files:
+                file.close()
+            self.metrics.observe("forward_attachments", time.perf_counter() - start)
+        return ",".join(ref for ref in results if ref) or None
+
+    def _upload_photos(self, results, batch):
+        try:
+            uploaded = self.upload.photo_messages([file for _, _, file in batch], peer_id=self.peer_id)
+        except Exception as e:
+            logger.warning("Ошибка загрузки %s фото, пересылаю ссылками: %s", len(batch), e)
+            self.metrics.inc("attachments_total", len(batch), result="failed")
+            return
+        for (index, digest, _), photo in zip(batch, uploaded):
+            results[index] = self.reference({"type": "photo", "photo": photo})
+            self.remember(digest, results[index])
+            self.metrics.inc("attachments_total", result="uploaded")
+
+    def _upload_doc(self, results, index, digest, file, title=None):
+        try:
+            uploaded = self.upload.document_message(file, title=title or os.path.basename(file.name), peer_id=self.peer_id)
+        except Exception as e:
+            logger.warning("Ошибка загрузки документа, пересылаю ссылкой: %s", e)
+            self.metrics.inc("attachments_total", result="failed")
+            return
+        results[index] = self.reference({"type": uploaded['type'], uploaded['type']: uploaded[uploaded['type']]})
+        self.remember(digest, results[index])
+        self.metrics.inc("attachments_total", result="uploaded")
+
+    def shutdown(self):
+        self.jobs.shutdown(wait=True)
+        self.downloads.shutdown(wait=True)
+
+class KeyboardRegistry:
+    """Готовые JSON-строки клавиатур для каждого режима, собранные один раз из декларативного описания."""
+
+    DEFAULTS = {
+        "main": [
+            [["ai_agent", "🤖 ПОДДЕРЖКА ИНТЕЛЛЕКТА", "primary"]],
+            [["contact_agent", "🧑‍💼 СВЯЗЬ С ОПЕРАТОРОМ", "secondary"]],
+            [["report_staff", "📋 ЖАЛОБА НА ПЕРСОНАЛ", "negative"]],
+            [["report_bug", "ℹ️ ВОЗНИКЛА НЕПОЛАДКА", "secondary"]]
+        ],
+        "ai": [[["end_ai", "🔄 ЗАВЕРШИТЬ ПОДДЕРЖКУ", "negative"]]],
+        "human": [[["end_human", "🔄 ВЕРНУТЬСЯ НАЗАД", "negative"]]],
+        "action": [[["cancel", "🔄 АННУЛИРОВАТЬ ОПЕРАЦИЮ", "negative"]]],
+        "admin": [
+            [["manage_agents", "🧑‍🏫 УПРАВЛЕНИЕ ШТАТОМ", "primary"]],
+            [["ban_user", "⛏ БЛОКИРОВКА ПОЛЬЗОВАТЕЛЯ", "negative"]],
+            [["broadcast", "📢 МАССОВОЕ ОПОВЕЩЕНИЕ", "positive"]],
+            [["cancel", "🔄 ВЕРНУТЬСЯ НАЗАД", "negative"]]
+        ],
+        "manage_agents": [
+            [["add_agent", "👥 ДОБАВИТЬ СОТРУДНИКА", "positive"]],
+            [["remove_agent", "🗑 УДАЛИТЬ СОТРУДНИКА", "negative"]],
+            [["cancel", "🔄 ВЕРНУТЬСЯ НАЗАД", "secondary"]]
+        ],
+        "ban_user": [
+            [["ban", "🔒 ЗАБЛОКИРОВАТЬ ДОСТУП", "negative"]],
+            [["unban", "🔓 РАЗБЛОКИРОВКА ДОСТУПА", "positive"]],
+            [["cancel", "🔄 ВЕРНУТЬСЯ НАЗАД", "secondary"]]
+        ],
+        "agent_rows": {
+            "main": [[["admin_panel", "🛠 ПАНЕЛЬ УПРАВЛЕНИЯ", "positive"]]]
+        }
+    }
+
+    def __init__(self, definitions=None):
+        self.load(definitions or {})
+
+    @staticmethod
+    def button(command, label, color):
+        return {"action": {"type": "text", "payload": {"command": command}, "label": label}, "color": color}
+
+    def render(self, rows):
+        buttons = [[self.button(*button) for button in row] for row in rows]
+        return json.dumps({"one_time": False, "buttons": buttons}, ensure_ascii=False)
+
+    def load(self, definitions):
+        definitions = dict(self.DEFAULTS, **definitions)
+        agent_rows = dict(self.DEFAULTS["agent_rows"], **definitions.pop("agent_rows", {}))
+        if not definitions.get("main"):
+            raise ValueError("Клавиатура main обязательна")
+        compiled = {}
+        for mode, rows in definitions.items():
+            compiled[(mode, False)] = self.render(rows)
+            compiled[(mode, True)] = self.render(agent_rows.get(mode, []) + rows)
+        self.compiled = compiled
+        logger.info("Клавиатуры собраны: %s режимов", len(definitions))
+
+    def get(self, mode, agent=False):
+        return self.compiled.get((mode, agent)) or self.compiled[("main", agent)]
+
+class MessageCatalog:
+    """Тексты сообщений, префиксы и промпт ИИ: подстановки разбираются и проверяются при загрузке."""
+
+    DEFAULT_PREFIX = "◾ СООБЩЕНИЕ"
+
+    def __init__(self, messages, prefixes, prompt):
+        self.defaults = {"messages": messages, "prefixes": prefixes, "prompt": prompt}
+        self.fields = {key: self._fields(text) for key, text in messages.items()}
+        self.load(self.defaults)
+
+    @staticmethod
+    def _fields(text):
+        fields = set()
+        for _, field, _, _ in string.Formatter().parse(text):
+            if field is None:
+                continue
+            if not field.isidentifier():
+                raise ValueError(f"недопустимая подстановка {{{field}}}")
+            fields.add(field)
+        return fields
+
+    def load(self, config):
+        messages = dict(self.defaults["messages"], **config.get("messages", {}))
+        compiled = {}
+        for key, text in messages.items():
+            try:
+                fields = self._fields(text)
+            except ValueError as e:
+                raise ValueError(f"Сообщение {key}: {e}")
+            unknown = fields - self.fields.get(key, fields)
+            if unknown:
+                raise ValueError(f"Сообщение {key}: неизвестные подстановки {', '.join(sorted(unknown))}")
+            compiled[key] = (text, True) if fields else ("".join(literal for literal, _, _, _ in string.Formatter().parse(text)), False)
+        prompt = config.get("prompt", self.defaults["prompt"])
+        if self._fields(prompt) != {"rules"}:
+            raise ValueError("Промпт должен содержать ровно одну подстановку {rules}")
+        prefixes = dict(self.defaults["prefixes"], **config.get("prefixes", {}))
+        self.state = (compiled, prefixes, prompt)
+        logger.info("Каталог сообщений собран: %s текстов", len(compiled))
+
+    def text(self, key):
+        entry = self.state[0].get(key)
+        return entry[0] if entry else key
+
+    def render(self, key, info=None):
+        entry = self.state[0].get(key)
+        if entry is None:
+            return key.format(**info) if info else key
+        text, templated = entry
+        return text.format_map(info) if templated and info else text
+
+    def prefix(self, action):
+        return self.state[1].get(action, self.DEFAULT_PREFIX)
+
+    def prompt(self, rules):
+        return self.state[2].format(rules=rules)
+
+def config_overrides(config):
+    config = dict(config)
+    for key, env in (("token", "VK_TOKEN"), ("admin_chat", "ADMIN_CHAT_ID"), ("group", "GROUP_ID")):
+        if os.environ.get(env):
+            config[key] = os.environ[env]
+    return config
+
+def load_config(path='candyxpe_config.json'):
+    config = {}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    config = config_overrides(config)
+    config.setdefault("admin_chat", 2)
+    config.setdefault("group", 230630628)
+    config["admin_chat"], config["group"] = int(config["admin_chat"]), int(config["group"])
+    return config
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours} ч {minutes} мин" if hours else f"{minutes} мин {seconds} с"
+
+def atomic_write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
 class SupportBot:
     VERSION = "0.4.0-RELEASE"
     CODE_NAME = "NOVA"
+    WORKERS = 32
+    AI_CONCURRENCY = 8
+    AI_QUEUE_LIMIT = 16
+    AI_WAIT = 15
+    SEND_RPS = 15
+    AI_STREAM = True
+    AI_PROVIDERS = ("auto",)
+    AI_TIMEOUT = 10
+    STREAM_MIN_CHARS = 20
+    STREAM_EDIT_INTERVAL = 1.5
+    RULES_TOP_K = 4
+    STATE_BACKEND = "sqlite"
+    STATE_PATH = "candyxpe_state.db"
+    CONTEXT_SIZE = 5
+    BROADCAST_SEGMENTS = {"#all", "#agents", "#active"}
+    SYNC_INTERVAL = 1
+    PROFILE_TTL = 86400
+    PROFILE_CACHE_SIZE = 10000
+    SENT_IDS_SIZE = 10000
+    CONFIG_INTERVAL = 2
+    METRICS_PORT = None
+    METRIC_STAGES = ("process_message", "process_command", "process_action", "get_ai_response", "send_message", "send_admin", "forward_attachments")
 
     MESSAGES = {
         "welcome": "😘 Добро пожаловать в бота тех.поддержки CandyxPE!\n\nВыберите действие:\n╰─> Официальное сообщество — информация о проекте.",
         "unknown": "▸ Команда не распознана.",
         "ai_on": "🤖 ИИ запущен! Задавайте вопросы.",
-        "human_on": "📣 Связь с оператором. Опишите ваш вопрос.",
+        "human_on": "📣 Связь с оператором. Опишите ваш вопрос.\n╰─> Обращение #{ticket_id}, позиция в очереди: {position}.",
+        "tickets": "▸ Открытые обращения ({count}):\n{tickets_list}\n\nСреднее время ответа: {response_time}\nСреднее время решения: {resolution_time}",
+        "ticket_closed": "▸ Обращение #{ticket_id} пользователя @id{target_id} закрыто.",
+        "no_ticket": "▸ У @id{target_id} нет открытого обращения.",
         "human_off": "▸ Вы вернулись в меню!",
         "report_staff": "⦿ Жалоба на персонал.\n\nОпишите ситуацию подробно.",
         "report_bug": "⦿ Сообщите о недочете техподдержке.",
@@ -29,7 +2107,7 @@ class SupportBot:
         "admin_panel": "▪️ Панель администрирования. Выберите действие.",
         "manage_agents": "◾ Управление сотрудниками. Выберите действие.",
         "ban_user": "⦿ Управление блокировками.\n\nОзнакомьтесь с [vk.com/topic-230626581_54557249|правилами].",
-        "broadcast": "◾ Введите текст объявления.",
+        "broadcast": "◾ Введите текст объявления.\n╰─> Аудитория: #all (по умолчанию), #agents, #active.",
         "add_agent": "▸ Укажите ID и роль: '123456789 agent/admin/manager'.",
         "remove_agent": "▸ Укажите ID для снятия роли.",
         "ban": "◾ Укажите ID и часы блокировки: '123456789 24'.",
@@ -39,7 +2117,7 @@ class SupportBot:
         "report_bug_sent": "▸ Недочет зафиксирован. Спасибо!",
         "report_staff_failed": "▸ Ошибка при отправке жалобы.",
         "report_bug_failed": "▸ Ошибка при отправке недочета.",
-        "broadcast_sent": "⦿ Объявление отправлено!",
+        "broadcast_sent": "⦿ Рассылка #{job_id} запущена: {total} получателей.",
         "broadcast_failed": "▸ Ошибка отправки объявления.",
         "self_agent": "◾ Нельзя назначить себя.",
         "already_agent": "╰─> @id{agent_id} уже сотрудник.",
@@ -57,11 +2135,20 @@ class SupportBot:
         "unbanned_notify": "▸ БЛОКИРОВКА ОТМЕНЕНА:\n╰─> Причина: решение руководства.",
         "not_banned": "▸ @id{target_id} не заблокирован.",
         "banned_user": "▸ Вы заблокированы.",
+        "already_banned": "▸ @id{target_id} уже заблокирован до {until}.",
+        "ban_expired_notify": "▸ Срок блокировки истёк. Доступ восстановлен.",
         "chat_unavailable": "⦿ Чат недоступен! Обратитесь к [vk.com/id1044729621|СОО].",
         "error": "◾ Ошибка! Попробуйте позже.",
+        "rate_limited": "◾ Слишком много запросов. Подождите немного.",
+        "muted": "◾ Вы временно ограничены за спам на {minutes} мин.",
+        "ai_busy": "🤖 ИИ сейчас перегружен. Повторите вопрос через минуту.",
+        "ai_fallback": "🤖 ИИ временно недоступен. Возможно, вам помогут пункты правил:\n{rules}\n\n╰─> Если вопрос не решён, свяжитесь с оператором.",
         "get_agents": "▸ Сотрудники:\n{agents_list}",
         "version": "⦿ Версия: {version} ({code_name})",
-        "stats": "▸ Статистика:\nПользователей: {users}\nСессий: {sessions}\nБлокировок: {bans}",
+        "stats": "▸ Статистика:\nПользователей: {users}\nСессий: {sessions}\nБлокировок: {bans}\nКэш ИИ: {cache_hits}/{cache_lookups} ({cache_rate:.0%})\nVK API: {vk_calls} вызовов, {vk_errors} ошибок\nОшибки ИИ: {ai_errors}\n\nПровайдеры ИИ:\n{providers}\n\nЗадержки p50/p99:\n{latency}",
+        "profile_started": "▸ Профилирование запущено. Остановить: /profile off.",
+        "profile_report": "▸ Профиль ({total} сэмплов):\n{report}",
+        "profile_idle": "▸ Профилирование не запущено.",
         "message_too_long": "◾ Сообщение слишком длинное (макс. 4096).",
         "permission_denied": "◾ Разрешите сообщения от группы."
     }
@@ -77,29 +2164,74 @@ class SupportBot:
         "remove_agent": "🗑 УДАЛЕНИЕ СОТРУДНИКА"
     }
 
-    def __init__(self, token, admin_chat, group):
+    PROMPT = (
+        "Ты - ИИ-ассистент техподдержки CandyxPE. Отвечай на русском по темам проекта: техвопросы, геймплей, баги, поддержка. Используй пункты правил:\n{rules}\n\n"
+        "Тон: вежливый, профессиональный. Ссылайся на пункты правил, если запрошены. Если пункт не найден, предложи уточнить. "
+        "Не давай код или информацию вне CandyxPE. Если запрос неясен, ответь: 'Уточните детали или обратитесь к агенту.'\n"
+        "Примеры:\n- Баг: 'Опишите проблему, укажите ID.'\n- Правила: 'Пункт 3.1: [цитата].'"
+    )
+
+    def __init__(self, token, admin_chat, group, shard=0, shards=1, vk_session=None, longpoll=None, ai_backend=None):
         self.token = token
         self.admin_chat = admin_chat
         self.group = group
-        self.vk = vk_api.VkApi(token=token).get_api()
-        self.longpoll = VkLongPoll(vk_api.VkApi(token=token))
-        self.upload = vk_api.VkUpload(vk_api.VkApi(token=token))
+        self.shard = shard
+        self.shards = shards
+        self.vk_session = vk_session or vk_api.VkApi(token=token)
+        self.longpoll = longpoll
+        self.ai_backend = ai_backend or self.call_provider
+        self.recorder = None
+        self.metrics = Metrics()
+        self.profiler = SamplingProfiler()
+        self.outbox = SendQueue(self.vk_session, self.SEND_RPS / shards, metrics=self.metrics)
+        self.upload = vk_api.VkUpload(VkApiMethod(self.outbox)) if isinstance(self.vk_session, vk_api.VkApi) else None
+        self.providers = ProviderPool(self.AI_PROVIDERS, self.ai_backend, self.metrics, self.AI_CONCURRENCY * 2, self.AI_TIMEOUT)
         self.rules = self.load_file('candyxpe_rules.txt', "Правила отсутствуют.", text=True)
+        self.rules_mtime = os.path.getmtime('candyxpe_rules.txt')
+        self.rules_index = RulesIndex()
+        self.rules_index.build(self.rules)
+        self.answers = AnswerCache()
+        self.answers.invalidate(self.rules_mtime)
         self.agents = self.load_file('candyxpe_agents.json', {})
-        self.banned = {}
-        self.ai_users = set()
-        self.human_users = set()
-        self.actions = {}
-        self.contexts = {}
-        self.stats = {"users": set(), "messages": 0}
-        self.spam = {}
-        self.prompt = (
-            "Ты - ИИ-ассистент техподдержки CandyxPE. Отвечай на русском по темам проекта: техвопросы, геймплей, баги, поддержка. Используй правила:\n{rules}\n\n"
-            "Тон: вежливый, профессиональный. Ссылайся на пункты правил, если запрошены. Если пункт не найден, предложи уточнить. "
-            "Не давай код или информацию вне CandyxPE. Если запрос неясен, ответь: 'Уточните детали или обратитесь к агенту.'\n"
-            "Примеры:\n- Баг: 'Опишите проблему, укажите ID.'\n- Правила: 'Пункт 3.1: [цитата].'"
-        )
-        self.msg_allowed_cache = {}
+        self.keyboards = KeyboardRegistry(self.load_file('candyxpe_keyboards.json', {}))
+        self.catalog = MessageCatalog(self.MESSAGES, self.PREFIXES, self.PROMPT)
+        self.catalog.load(self.load_file('candyxpe_messages.json', {}))
+        self.store = self.open_store()
+        self.banned = BanRegistry(self.store, self.notify_unbanned, self.publish if shards > 1 else None, self.owns if shards > 1 else None)
+        self.ai_users = PersistentSet(self.store, "ai_users")
+        self.human_users = PersistentSet(self.store, "human_users")
+        self.actions = PersistentDict(self.store, "actions")
+        self.sessions = SessionStore(self.store)
+        self.limiter = RateLimiter(self.load_file('candyxpe_limits.json', {}))
+        registers = self.store.get("stats", self.stat_key("users"))
+        self.stats = {"users": HyperLogLog(registers=bytes.fromhex(registers) if registers else None), "messages": self.store.get("stats", self.stat_key("messages"), 0)}
+        self.lock = threading.RLock()
+        self.ai_slots = threading.BoundedSemaphore(self.AI_CONCURRENCY)
+        self.ai_queue = threading.BoundedSemaphore(self.AI_QUEUE_LIMIT)
+        self.dispatcher = EventDispatcher(self.process_message, self.WORKERS)
+        self.sent_ids = OrderedDict()
+        self.broadcasts = BroadcastJobs(self.store, self.outbox, self.notify_admin_chat, self.remember_sent)
+        self.tickets = TicketQueue(self.store, lambda: self.agents, self.stat_key("tickets"), shards > 1, self.owns)
+        self.attachments = AttachmentPipeline(self.api, self.upload, 2000000000 + admin_chat, self.store, self.metrics, getattr(self.vk_session, "http", None))
+        self.profiles = OrderedDict()
+        self.forwards = {}
+        self.reloaders = {
+            'candyxpe_messages.json': self.catalog.load,
+            'candyxpe_keyboards.json': self.keyboards.load,
+            'candyxpe_limits.json': self.limiter.configure,
+            'candyxpe_config.json': self.apply_config
+        }
+        self.config_mtimes = {path: self.file_mtime(path) for path in self.reloaders}
+        self.register_gauges()
+        threading.Thread(target=self.watch_config, name="config-watcher", daemon=True).start()
+
+    def stat_key(self, name):
+        return name if self.shards == 1 else f"{name}:{self.shard}"
+
+    def open_store(self):
+        if self.STATE_BACKEND == "journal" and self.shards == 1:
+            return JournalStateStore(self.STATE_PATH)
+        return SqliteStateStore(self.STATE_PATH)
 
     def load_file(self, path, default, text=False):
         if not os.path.exists(path):
@@ -108,127 +2240,179 @@ class SupportBot:
             return f.read().strip() if text else json.load(f)
 
     def save_file(self, path, data):
-        with open(path, 'w', encoding='utf-8') as f:
-            if isinstance(data, str):
-                f.write(data)
-            else:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+        atomic_write(path, data if isinstance(data, str) else json.dumps(data, ensure_ascii=False, indent=2))
+
+    def save_agents(self):
+        agents = json.loads(json.dumps(self.agents))
+        self.store.submit(lambda: self.save_file('candyxpe_agents.json', agents))
+        if self.shards > 1:
+            self.publish("agents", agents)
+
+    def publish(self, kind, data):
+        try:
+            self.store.publish(self.shard, kind, data)
+        except Exception as e:
+            logger.error("Ошибка публикации изменения %s: %s", kind, e)
+
+    def sync_shards(self):
+        seq = self.store.changes(None)[0][0]
+        while True:
+            time.sleep(self.SYNC_INTERVAL)
+            try:
+                changes = self.store.changes(seq)
+            except Exception as e:
+                logger.error("Ошибка синхронизации шарда %s: %s", self.shard, e)
+                continue
+            for seq, origin, kind, data in changes:
+                if origin == self.shard:
+                    continue
+                if kind == "ban":
+                    self.banned.apply_ban(data["uid"], data["expiry"])
+                elif kind == "unban":
+                    self.banned.apply_unban(data["uid"])
+                elif kind == "agents":
+                    self.agents = data
+                elif kind == "close_ticket" and self.owns(data["uid"]):
+                    self.close_ticket(data["agent"], data["uid"])
+                logger.debug("Шард %s применил изменение %s от шарда %s", self.shard, kind, origin)
+
+    def collect_stats(self):
+        if self.shards == 1:
+            return len(self.stats["users"]), len(self.ai_users | self.human_users)
+        users = HyperLogLog()
+        for key, value in self.store.load("stats").items():
+            if key.startswith("users:"):
+                users.merge(bytes.fromhex(value))
+        sessions = set(self.store.load("ai_users")) | set(self.store.load("human_users"))
+        return len(users), len(sessions)
+
+    def api(self, method, **params):
+        result = self.outbox.call(method, params)
+        if method == "messages.send":
+            self.remember_sent(result)
+        return result
 
+    def remember_sent(self, result):
+        ids = [item.get("message_id") for item in result if isinstance(item, dict)] if isinstance(result, list) else [result]
+        with self.lock:
+            for message_id in ids:
+                if message_id:
+                    self.sent_ids[message_id] = True
+            while len(self.sent_ids) > self.SENT_IDS_SIZE:
+                self.sent_ids.popitem(last=False)
+
+    def is_operator_reply(self, event):
+        author = getattr(event, 'admin_author', None)
+        if author is not None:
+            return author > 0
+        with self.lock:
+            return event.message_id not in self.sent_ids
+
+    @timed("send_message")
     def send_message(self, user, key, keyboard=None, info=None, retry=False):
-        logger.debug(f"send_message called with user={user}, key={key}, retry={retry}")
+        logger.debug("send_message called with user=%s, key=%s, retry=%s", user, key, retry)
         try:
-            if user not in self.msg_allowed_cache or time.time() - self.msg_allowed_cache[user][1] > 3600:
+            session = self.sessions.get(user)
+            if session.allowed is None or time.time() - session.allowed_at > 3600:
                 try:
-                    allowed = self.vk.messages.isMessagesFromGroupAllowed(user_id=user, group_id=self.group).get('is_allowed', False)
-                    self.msg_allowed_cache[user] = (allowed, time.time())
+                    allowed = self.api("messages.isMessagesFromGroupAllowed", user_id=user, group_id=self.group).get('is_allowed', False)
+                    session.allowed, session.allowed_at = bool(allowed), time.time()
                 except Exception as e:
-                    logger.error(f"Ошибка проверки isMessagesFromGroupAllowed для {user}: {e}")
+                    logger.error("Ошибка проверки isMessagesFromGroupAllowed для %s: %s", user, e)
                     allowed = False
             else:
-                allowed = self.msg_allowed_cache[user][0]
+                allowed = session.allowed
 
             if not allowed and not retry:
-                logger.warning(f"Сообщения для {user} запрещены")
+                logger.warning("Сообщения для %s запрещены", user)
                 try:
-                    self.vk.messages.send(
+                    self.api(
+                        "messages.send",
                         user_id=user,
-                        message=self.MESSAGES["permission_denied"],
+                        message=self.catalog.text("permission_denied"),
                         random_id=get_random_id(),
-                        keyboard=json.dumps(self.get_keyboard("main", user), ensure_ascii=False)
+                        keyboard=self.get_keyboard("main", user)
                     )
-                    logger.info(f"Отправлено permission_denied пользователю {user}")
+                    logger.info("Отправлено permission_denied пользователю %s", user)
                 except Exception as e:
-                    logger.error(f"Не удалось отправить permission_denied пользователю {user}: {e}")
+                    logger.error("Не удалось отправить permission_denied пользователю %s: %s", user, e)
                 return
 
-            msg = self.MESSAGES.get(key, key)
-            if info:
-                try:
-                    msg = msg.format(**info)
-                except KeyError as e:
-                    logger.error(f"Ошибка форматирования сообщения для {user}, ключ: {key}, info: {info}, ошибка: {e}")
-                    msg = self.MESSAGES["error"]
+            try:
+                msg = self.catalog.render(key, info)
+            except (KeyError, ValueError, IndexError) as e:
+                logger.error("Ошибка форматирования сообщения для %s, ключ: %s, info: %s, ошибка: %s", user, key, info, e)
+                msg = self.catalog.text("error")
 
             params = {'user_id': user, 'message': msg, 'random_id': get_random_id()}
             if keyboard:
                 try:
-                    params['keyboard'] = json.dumps(keyboard, ensure_ascii=False)
+                    params['keyboard'] = keyboard if isinstance(keyboard, str) else json.dumps(keyboard, ensure_ascii=False)
                 except Exception as e:
-                    logger.error(f"Ошибка формирования клавиатуры для {user}: {e}")
-                    params['keyboard'] = json.dumps(self.get_keyboard("main", user), ensure_ascii=False)
+                    logger.error("Ошибка формирования клавиатуры для %s: %s", user, e)
+                    params['keyboard'] = self.get_keyboard("main", user)
 
             if info and info.get('attachment'):
                 params['attachment'] = info['attachment']
 
-            self.vk.messages.send(**params)
-            logger.info(f"Сообщение отправлено пользователю {user}: {msg[:50]}")
+            message_id = self.api("messages.send", **params)
+            logger.debug("Сообщение отправлено пользователю %s: %s", user, msg[:50])
+            return message_id
         except vk_api.exceptions.ApiError as e:
-            logger.error(f"VK API ошибка при отправке пользователю {user}: {e} (код: {getattr(e, 'code', 'неизвестен')})")
+            logger.error("VK API ошибка при отправке пользователю %s: %s (код: %s)", user, e, getattr(e, 'code', 'неизвестен'))
             if not retry:
                 try:
-                    self.vk.messages.send(
+                    self.api(
+                        "messages.send",
                         user_id=user,
-                        message=self.MESSAGES["error"],
+                        message=self.catalog.text("error"),
                         random_id=get_random_id(),
-                        keyboard=json.dumps(self.get_keyboard("main", user), ensure_ascii=False)
+                        keyboard=self.get_keyboard("main", user)
                     )
-                    logger.info(f"Отправлено сообщение об ошибке пользователю {user}")
+                    logger.info("Отправлено сообщение об ошибке пользователю %s", user)
                 except Exception as e:
-                    logger.error(f"Не удалось отправить сообщение об ошибке пользователю {user}: {e}")
+                    logger.error("Не удалось отправить сообщение об ошибке пользователю %s: %s", user, e)
         except Exception as e:
-            logger.error(f"Неизвестная ошибка в send_message для {user}, ключ: {key}: {e}")
+            logger.error("Неизвестная ошибка в send_message для %s, ключ: %s: %s", user, key, e)
             if not retry:
                 try:
-                    self.vk.messages.send(
+                    self.api(
+                        "messages.send",
                         user_id=user,
-                        message=self.MESSAGES["error"],
+                        message=self.catalog.text("error"),
                         random_id=get_random_id(),
-                        keyboard=json.dumps(self.get_keyboard("main", user), ensure_ascii=False)
+                        keyboard=self.get_keyboard("main", user)
                     )
-                    logger.info(f"Отправлено сообщение об ошибке пользователю {user}")
+                    logger.info("Отправлено сообщение об ошибке пользователю %s", user)
                 except Exception as e:
-                    logger.error(f"Не удалось отправить сообщение об ошибке пользователю {user}: {e}")
+                    logger.error("Не удалось отправить сообщение об ошибке пользователю %s: %s", user, e)
 
     def get_keyboard(self, mode, user=None):
-        keyboards = {
-            "main": [
-                [{"action": {"type": "text", "payload": {"command": "ai_agent"}, "label": "🤖 ПОДДЕРЖКА ИНТЕЛЛЕКТА"}, "color": "primary"}],
-                [{"action": {"type": "text", "payload": {"command": "contact_agent"}, "label": "🧑‍💼 СВЯЗЬ С ОПЕРАТОРОМ"}, "color": "secondary"}],
-                [{"action": {"type": "text", "payload": {"command": "report_staff"}, "label": "📋 ЖАЛОБА НА ПЕРСОНАЛ"}, "color": "negative"}],
-                [{"action": {"type": "text", "payload": {"command": "report_bug"}, "label": "ℹ️ ВОЗНИКЛА НЕПОЛАДКА"}, "color": "secondary"}]
-            ],
-            "ai": [[{"action": {"type": "text", "payload": {"command": "end_ai"}, "label": "🔄 ЗАВЕРШИТЬ ПОДДЕРЖКУ"}, "color": "negative"}]],
-            "human": [[{"action": {"type": "text", "payload": {"command": "end_human"}, "label": "🔄 ВЕРНУТЬСЯ НАЗАД"}, "color": "negative"}]],
-            "action": [[{"action": {"type": "text", "payload": {"command": "cancel"}, "label": "🔄 АННУЛИРОВАТЬ ОПЕРАЦИЮ"}, "color": "negative"}]],
-            "admin": [
-                [{"action": {"type": "text", "payload": {"command": "manage_agents"}, "label": "🧑‍🏫 УПРАВЛЕНИЕ ШТАТОМ"}, "color": "primary"}],
-                [{"action": {"type": "text", "payload": {"command": "ban_user"}, "label": "⛏ БЛОКИРОВКА ПОЛЬЗОВАТЕЛЯ"}, "color": "negative"}],
-                [{"action": {"type": "text", "payload": {"command": "broadcast"}, "label": "📢 МАССОВОЕ ОПОВЕЩЕНИЕ"}, "color": "positive"}],
-                [{"action": {"type": "text", "payload": {"command": "cancel"}, "label": "🔄 ВЕРНУТЬСЯ НАЗАД"}, "color": "negative"}]
-            ],
-            "manage_agents": [
-                [{"action": {"type": "text", "payload": {"command": "add_agent"}, "label": "👥 ДОБАВИТЬ СОТРУДНИКА"}, "color": "positive"}],
-                [{"action": {"type": "text", "payload": {"command": "remove_agent"}, "label": "🗑 УДАЛИТЬ СОТРУДНИКА"}, "color": "negative"}],
-                [{"action": {"type": "text", "payload": {"command": "cancel"}, "label": "🔄 ВЕРНУТЬСЯ НАЗАД"}, "color": "secondary"}]
-            ],
-            "ban_user": [
-                [{"action": {"type": "text", "payload": {"command": "ban"}, "label": "🔒 ЗАБЛОКИРОВАТЬ ДОСТУП"}, "color": "negative"}],
-                [{"action": {"type": "text", "payload": {"command": "unban"}, "label": "🔓 РАЗБЛОКИРОВКА ДОСТУПА"}, "color": "positive"}],
-                [{"action": {"type": "text", "payload": {"command": "cancel"}, "label": "🔄 ВЕРНУТЬСЯ НАЗАД"}, "color": "secondary"}]
-            ]
-        }
-        buttons = keyboards.get(mode, keyboards["main"])
-        if user and mode == "main" and str(user) in self.agents:
-            buttons.insert(0, [{"action": {"type": "text", "payload": {"command": "admin_panel"}, "label": "🛠 ПАНЕЛЬ УПРАВЛЕНИЯ"}, "color": "positive"}])
-        return {"one_time": False, "buttons": buttons}
+        return self.keyboards.get(mode, user is not None and str(user) in self.agents)
 
-    def send_admin(self, user, message, action, attachments=None):
-        prefix = self.PREFIXES.get(action, "◾ СООБЩЕНИЕ")
+    def get_user_name(self, user):
+        cached = self.profiles.get(user)
+        if cached and time.time() - cached[1] < self.PROFILE_TTL:
+            return cached[0]
         try:
-            user_info = self.vk.users.get(user_ids=user)[0]
-            info = f"\n👤 [id{user}|{user_info['first_name']} {user_info['last_name']}]\n◾ Диалог: [vk.com/gim230630628?sel={user}|перейти]\n╰─> Рассмотрите обращение."
+            user_info = self.api("users.get", user_ids=user)[0]
+            name = f"{user_info['first_name']} {user_info['last_name']}"
         except Exception:
-            info = f"\n👤 [id{user}|id{user}]\n◾ Диалог: [vk.com/gim230630628?sel={user}|перейти]\n╰─> Рассмотрите обращение."
+            return f"id{user}"
+        with self.lock:
+            self.profiles[user] = (name, time.time())
+            self.profiles.move_to_end(user)
+            while len(self.profiles) > self.PROFILE_CACHE_SIZE:
+                self.profiles.popitem(last=False)
+        return name
+
+    @timed("send_admin")
+    def send_admin(self, user, message, action, attachments=None, ticket=None):
+        prefix = self.catalog.prefix(action)
+        info = f"\n👤 [id{user}|{self.get_user_name(user)}]\n◾ Диалог: [vk.com/gim{self.group}?sel={user}|перейти]\n╰─> Рассмотрите обращение."
+        if ticket:
+            assignee = f"@id{ticket['assignee']}" if ticket["assignee"] else "не назначено"
+            info = f"\n🎫 Обращение #{ticket['id']} → {assignee}{info}"
         params = {
             "chat_id": self.admin_chat,
             "message": f"{prefix}{info}\n\n{message}",
@@ -237,62 +2421,249 @@ class SupportBot:
         if attachments:
             params["attachment"] = attachments
         try:
-            self.vk.messages.send(**params)
-            logger.info(f"Отправлено в админ-чат (тип: {action}): {message[:50]}...")
+            self.api("messages.send", **params)
+            logger.info("Отправлено в админ-чат (тип: %s): %s...", action, message[:50])
             return True
         except Exception as e:
-            logger.error(f"Ошибка отправки в админ-чат: {e}")
+            logger.error("Ошибка отправки в админ-чат: %s", e)
             self.send_message(user, "chat_unavailable")
             return False
 
+    def after_attachments(self, user, attachments, callback):
+        with self.lock:
+            previous = self.forwards.get(user)
+            if attachments is None and (previous is None or previous.done()):
+                self.forwards.pop(user, None)
+                previous = None
+            else:
+                finished = self.forwards[user] = Future()
+        if attachments is None and previous is None:
+            callback(None)
+            return
+        waiting = [future for future in (previous, attachments) if future is not None]
+        remaining = [len(waiting)]
+        def ready(_):
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            try:
+                callback(attachments.result() if attachments else None)
+            except Exception as e:
+                logger.error("Ошибка пересылки обращения %s с вложениями: %s", user, e)
+            finally:
+                with self.lock:
+                    if self.forwards.get(user) is finished:
+                        del self.forwards[user]
+                finished.set_result(None)
+        for future in waiting:
+            future.add_done_callback(ready)
+
+    def acquire_ai_slot(self):
+        if not self.limiter.allow_global("ai"):
+            return False
+        if not self.ai_queue.acquire(blocking=False):
+            return False
+        try:
+            return self.ai_slots.acquire(timeout=self.AI_WAIT)
+        finally:
+            self.ai_queue.release()
+
+    def refresh_rules(self):
+        try:
+            mtime = os.path.getmtime('candyxpe_rules.txt')
+        except OSError:
+            return
+        if mtime != self.rules_mtime:
+            self.rules = self.load_file('candyxpe_rules.txt', "Правила отсутствуют.", text=True)
+            self.rules_mtime = mtime
+            self.rules_index.build(self.rules)
+            self.answers.invalidate(mtime)
+            logger.info("Правила обновлены, кэш ответов ИИ сброшен")
+
+    @staticmethod
+    def file_mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def watch_config(self):
+        while True:
+            time.sleep(self.CONFIG_INTERVAL)
+            self.refresh_rules()
+            for path, apply in self.reloaders.items():
+                mtime = self.file_mtime(path)
+                if mtime is None or mtime == self.config_mtimes.get(path):
+                    continue
+                self.config_mtimes[path] = mtime
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        apply(json.load(f))
+                    logger.info("Конфигурация %s перезагружена", path)
+                except Exception as e:
+                    logger.error("Ошибка в %s, оставлена прежняя версия: %s", path, e)
+
+    def apply_config(self, config):
+        config = config_overrides(config)
+        admin_chat = int(config.get("admin_chat", self.admin_chat))
+        group = int(config.get("group", self.group))
+        self.admin_chat, self.group = admin_chat, group
+        self.attachments.peer_id = 2000000000 + admin_chat
+
+    def get_context(self, user):
+        return self.sessions.get(user).context
+
+    def set_context(self, user, context):
+        context = context[-self.CONTEXT_SIZE:]
+        self.sessions.get(user).context = context
+        if context:
+            self.store.put("contexts", user, context)
+        else:
+            self.store.delete("contexts", user)
+
+    def cached_ai_response(self, user, message):
+        if self.get_context(user):
+            return None
+        answer = self.answers.get(message)
+        self.metrics.inc("ai_cache_misses_total" if answer is None else "ai_cache_hits_total")
+        if answer is not None:
+            self.set_context(user, [{"role": "user", "content": message}, {"role": "assistant", "content": answer}])
+        return answer
+
+    def prepare_ai_messages(self, user, message):
+        self.set_context(user, self.get_context(user) + [{"role": "user", "content": message}])
+        rules = self.rules_index.render(self.rules_index.search(message, self.RULES_TOP_K)) or "Подходящие пункты не найдены."
+        prompt = self.catalog.prompt(rules)
+        return [{"role": "system", "content": prompt}] + self.get_context(user)
+
+    def clean_ai_response(self, response):
+        cleaned_response = response.replace('*', '')
+        return cleaned_response[:4090] + "..." if len(cleaned_response) > 4096 else cleaned_response
+
+    def resolve_provider(self, name):
+        return None if name == "auto" else getattr(g4f.Provider, name)
+
+    def call_provider(self, name, messages, stream=False):
+        return g4f.ChatCompletion.create(
+            model="gpt-4",
+            provider=self.resolve_provider(name),
+            messages=messages,
+            max_tokens=500,
+            temperature=0.7,
+            timeout=self.AI_TIMEOUT,
+            stream=stream
+        )
+
+    def fallback_ai_response(self, message):
+        sections = self.rules_index.search(message, self.RULES_TOP_K)
+        if not sections:
+            return self.catalog.text("error")
+        self.metrics.inc("ai_fallback_total")
+        return self.clean_ai_response(self.catalog.render("ai_fallback", {"rules": self.rules_index.render(sections)}))
+
+    @timed("get_ai_response")
     def get_ai_response(self, user, message):
-        if user not in self.contexts:
-            self.contexts[user] = []
-        self.contexts[user].append({"role": "user", "content": message})
-        self.contexts[user] = self.contexts[user][-5:]
-        prompt = self.prompt.format(rules=self.rules)
-        messages = [
-            {"role": "system", "content": prompt},
-            {"role": "system", "content": f"Правила CandyxPE:\n{self.rules}"}
-        ] + self.contexts[user]
+        messages = self.prepare_ai_messages(user, message)
+        if not self.acquire_ai_slot():
+            logger.warning("Нет свободных слотов ИИ для %s", user)
+            self.metrics.inc("ai_busy_total")
+            self.set_context(user, self.get_context(user)[:-1])
+            return self.catalog.text("ai_busy")
+        try:
+            response = self.providers.complete(messages)
+        finally:
+            self.ai_slots.release()
+        if response is None:
+            logger.error("Ошибка ИИ: нет ответа ни от одного провайдера")
+            self.metrics.inc("ai_errors_total", kind="unavailable")
+            self.set_context(user, self.get_context(user)[:-1])
+            return self.fallback_ai_response(message)
+        cleaned_response = self.clean_ai_response(response)
+        if len(self.get_context(user)) == 1:
+            self.answers.put(message, cleaned_response)
+        self.set_context(user, self.get_context(user) + [{"role": "assistant", "content": response.replace('*', '')}])
+        return cleaned_response
+
+    @timed("get_ai_response")
+    def stream_ai_response(self, user, message):
+        messages = self.prepare_ai_messages(user, message)
+        keyboard = self.get_keyboard("ai", user)
+        if not self.acquire_ai_slot():
+            logger.warning("Нет свободных слотов ИИ для %s", user)
+            self.metrics.inc("ai_busy_total")
+            self.set_context(user, self.get_context(user)[:-1])
+            self.send_message(user, "ai_busy", keyboard)
+            return
+        response = ""
+        message_id = None
+        shown = ""
+        last_edit = 0.0
         try:
-            response = g4f.ChatCompletion.create(
-                model="gpt-4",
-                messages=messages,
-                max_tokens=500,
-                temperature=0.7,
-                timeout=10
-            )
-            if isinstance(response, str) and response.strip():
-                cleaned_response = response.replace('*', '')
-                self.contexts[user].append({"role": "assistant", "content": cleaned_response})
-                return cleaned_response[:4090] + "..." if len(cleaned_response) > 4096 else cleaned_response
-            logger.error(f"Ошибка ИИ: пустой или некорректный ответ")
-            return self.MESSAGES["error"]
+            for chunk in self.providers.stream(messages):
+                response += chunk
+                text = self.clean_ai_response(response).strip()
+                if message_id is None:
+                    if len(text) >= self.STREAM_MIN_CHARS:
+                        message_id = self.send_message(user, text, keyboard)
+                        shown = text
+                        last_edit = time.monotonic()
+                        if message_id is None:
+                            return
+                elif text != shown and time.monotonic() - last_edit >= self.STREAM_EDIT_INTERVAL:
+                    self.edit_message(user, message_id, text, keyboard)
+                    shown = text
+                    last_edit = time.monotonic()
         except Exception as e:
-            logger.error(f"Ошибка ИИ: {e}")
-            return self.MESSAGES["error"]
+            logger.error("Ошибка потока ИИ: %s", e)
+            self.metrics.inc("ai_errors_total", kind="timeout" if "timeout" in type(e).__name__.lower() else "error")
+        finally:
+            self.ai_slots.release()
+        text = self.clean_ai_response(response).strip()
+        if not text:
+            logger.error("Ошибка ИИ: пустой или некорректный ответ")
+            self.metrics.inc("ai_errors_total", kind="unavailable")
+            self.set_context(user, self.get_context(user)[:-1])
+            text = self.fallback_ai_response(message)
+        else:
+            if len(self.get_context(user)) == 1:
+                self.answers.put(message, text)
+            self.set_context(user, self.get_context(user) + [{"role": "assistant", "content": response.replace('*', '')}])
+        if message_id is None:
+            self.send_message(user, text, keyboard)
+        elif text != shown:
+            self.edit_message(user, message_id, text, keyboard)
 
+    def edit_message(self, user, message_id, text, keyboard=None):
+        params = {"peer_id": user, "message_id": message_id, "message": text}
+        if keyboard:
+            params["keyboard"] = keyboard if isinstance(keyboard, str) else json.dumps(keyboard, ensure_ascii=False)
+        try:
+            self.api("messages.edit", **params)
+        except Exception as e:
+            logger.error("Не удалось изменить сообщение %s пользователя %s: %s", message_id, user, e)
+
+    @timed("process_command")
     def process_command(self, user, cmd):
-        logger.debug(f"Обработка команды {cmd} для пользователя {user}")
+        logger.debug("Обработка команды %s для пользователя %s", cmd, user)
         def execute_command(action, success_message, keyboard_mode, condition=True):
             if condition:
                 if action:
                     action()
-                logger.debug(f"Отправка сообщения {success_message} пользователю {user} с клавиатурой {keyboard_mode}")
+                logger.debug("Отправка сообщения %s пользователю %s с клавиатурой %s", success_message, user, keyboard_mode)
                 self.send_message(user, success_message, self.get_keyboard(keyboard_mode, user))
             else:
-                logger.debug(f"Доступ запрещен для команды {cmd} пользователю {user}")
+                logger.debug("Доступ запрещен для команды %s пользователю %s", cmd, user)
                 self.send_message(user, "admin_denied", self.get_keyboard("admin", user))
 
         commands = {
-            "ai_agent": lambda: execute_command(lambda: (self.ai_users.add(user), self.human_users.discard(user)), "ai_on", "ai", True),
-            "contact_agent": lambda: execute_command(lambda: (self.human_users.add(user), self.ai_users.discard(user), self.send_admin(user, "✱ Пользователь подключён к оператору.", "agent")), "human_on", "human", True),
-            "end_human": lambda: execute_command(lambda: (self.human_users.discard(user), self.actions.pop(user, None), self.ai_users.discard(user)), "human_off", "main", True),
-            "report_staff": lambda: execute_command(lambda: (self.actions.update({user: "staff"}), self.human_users.discard(user)), "report_staff", "action", True),
+            "ai_agent": lambda: execute_command(lambda: (self.ai_users.add(user), self.leave_human(user)), "ai_on", "ai", True),
+            "contact_agent": lambda: self.contact_agent(user),
+            "end_human": lambda: execute_command(lambda: (self.leave_human(user), self.actions.pop(user, None), self.ai_users.discard(user)), "human_off", "main", True),
+            "report_staff": lambda: execute_command(lambda: (self.actions.update({user: "staff"}), self.leave_human(user)), "report_staff", "action", True),
             "report_bug": lambda: execute_command(lambda: self.actions.update({user: "bug"}), "report_bug", "action", True),
-            "end_ai": lambda: execute_command(lambda: (self.ai_users.discard(user), self.actions.pop(user, None), self.contexts.pop(user, None), self.human_users.discard(user)), "ai_off", "main", True),
-            "cancel": lambda: execute_command(lambda: (self.actions.pop(user, None), self.ai_users.discard(user), self.human_users.discard(user)), "cancel", "main", True),
+            "end_ai": lambda: execute_command(lambda: (self.ai_users.discard(user), self.actions.pop(user, None), self.set_context(user, []), self.leave_human(user)), "ai_off", "main", True),
+            "cancel": lambda: execute_command(lambda: (self.actions.pop(user, None), self.ai_users.discard(user), self.leave_human(user)), "cancel", "main", True),
             "admin_panel": lambda: execute_command(None, "admin_panel", "admin", str(user) in self.agents),
             "manage_agents": lambda: execute_command(None, "manage_agents", "manage_agents", str(user) in self.agents and self.agents[str(user)].get("role") in ["admin", "manager"]),
             "ban_user": lambda: execute_command(None, "ban_user", "ban_user", str(user) in self.agents and self.agents[str(user)].get("role") in ["admin", "manager"]),
@@ -314,35 +2685,96 @@ class SupportBot:
                 self.send_message(user, "admin_denied", self.get_keyboard("admin", user))
         elif cmd.lower() == "stats":
             if str(user) in self.agents:
+                users, sessions = self.collect_stats()
                 self.send_message(user, "stats", self.get_keyboard("admin", user), {
-                    "users": len(self.stats["users"]),
-                    "sessions": len(self.ai_users | self.human_users),
-                    "bans": len(self.banned)
+                    "users": users,
+                    "sessions": sessions,
+                    "bans": len(self.banned),
+                    "cache_hits": self.answers.hits,
+                    "cache_lookups": self.answers.hits + self.answers.misses,
+                    "cache_rate": self.answers.hit_rate(),
+                    "vk_calls": self.metrics.total("vk_api_calls_total"),
+                    "vk_errors": self.metrics.total("vk_api_errors_total"),
+                    "ai_errors": self.metrics.total("ai_errors_total"),
+                    "providers": self.providers.report(),
+                    "latency": self.latency_report()
                 })
             else:
                 self.send_message(user, "admin_denied", self.get_keyboard("admin", user))
         elif cmd.lower() == "version":
             self.send_message(user, "version", self.get_keyboard("main", user), {"version": self.VERSION, "code_name": self.CODE_NAME})
+        elif cmd.lower() in ("profile on", "profile off"):
+            if str(user) in self.agents and self.agents[str(user)].get("role") == "manager":
+                if cmd.lower() == "profile on":
+                    self.profiler.start()
+                    self.send_message(user, "profile_started", self.get_keyboard("admin", user))
+                else:
+                    result = self.profiler.stop()
+                    if result is None:
+                        self.send_message(user, "profile_idle", self.get_keyboard("admin", user))
+                    else:
+                        samples, total = result
+                        report = "\n".join(f"{count * 100 // max(total, 1)}% {location}" for location, count in samples) or "Нет данных."
+                        self.send_message(user, "profile_report", self.get_keyboard("admin", user), {"total": total, "report": report})
+            else:
+                self.send_message(user, "admin_denied", self.get_keyboard("admin", user))
+        elif cmd.lower() == "tickets":
+            if str(user) in self.agents:
+                tickets, count, sla = self.tickets.snapshot()
+                now = time.time()
+                tickets_list = "\n".join(
+                    f"#{t['id']} @id{t['user']} → {'@id' + t['assignee'] if t['assignee'] else 'не назначено'}, "
+                    f"{format_duration(now - t['created'])}{'' if t['first_response'] else ', ждёт ответа'}"
+                    for t in tickets
+                ) or "Нет обращений."
+                self.send_message(user, "tickets", self.get_keyboard("admin", user), {
+                    "count": count,
+                    "tickets_list": tickets_list,
+                    "response_time": format_duration(sla["response_time"] / sla["responses"]) if sla["responses"] else "—",
+                    "resolution_time": format_duration(sla["resolution_time"] / sla["resolved"]) if sla["resolved"] else "—"
+                })
+            else:
+                self.send_message(user, "admin_denied", self.get_keyboard("admin", user))
+        elif cmd.lower().startswith("close "):
+            if str(user) in self.agents:
+                try:
+                    target_id = int(cmd.split()[1])
+                except (IndexError, ValueError):
+                    self.send_message(user, "invalid_id", self.get_keyboard("admin", user))
+                    return
+                if self.owns(target_id):
+                    self.close_ticket(user, target_id)
+                elif self.tickets.find(target_id):
+                    self.publish("close_ticket", {"uid": target_id, "agent": user})
+                else:
+                    self.send_message(user, "no_ticket", self.get_keyboard("admin", user), {"target_id": target_id})
+            else:
+                self.send_message(user, "admin_denied", self.get_keyboard("admin", user))
         else:
             commands.get(cmd.lower(), lambda: self.send_message(user, "unknown", self.get_keyboard("main", user)))()
 
+    @timed("process_action")
     def process_action(self, user, action, text, attachments=None):
         if action in ["staff", "bug"]:
-            success = self.send_admin(user, text, action, attachments)
-            self.send_message(user, f"report_{action}_sent" if success else f"report_{action}_failed", self.get_keyboard("main", user))
             self.actions.pop(user, None)
+            def finish(attachment):
+                success = self.send_admin(user, text, action, attachment)
+                self.send_message(user, f"report_{action}_sent" if success else f"report_{action}_failed", self.get_keyboard("main", user))
+            self.after_attachments(user, attachments, finish)
         elif action == "broadcast":
             if str(user) in self.agents and self.agents[str(user)].get("role") in ["admin", "manager"]:
                 if len(text) > 4096:
                     self.send_message(user, "message_too_long", self.get_keyboard("admin", user))
                 else:
-                    sent_count = 0
-                    for uid in self.agents:
-                        if int(uid) not in self.banned:
-                            self.send_message(int(uid), f"📢 ОПОВЕЩЕНИЕ:\n{text}", self.get_keyboard("main", int(uid)))
-                            sent_count += 1
-                    self.send_admin(user, f"📢 Объявление отправлено {sent_count} пользователям.", "broadcast")
-                    self.send_message(user, "broadcast_sent", self.get_keyboard("admin", user))
+                    segment, _, rest = text.partition(" ")
+                    if segment in self.BROADCAST_SEGMENTS and rest.strip():
+                        text = rest.strip()
+                    else:
+                        segment = "#all"
+                    recipients = [uid for uid in self.broadcast_audience(segment) if not self.banned.is_banned(uid)]
+                    job_id = self.broadcasts.start(text, recipients, user, segment)
+                    self.send_admin(user, f"📢 Рассылка #{job_id} ({segment}) запущена для {len(recipients)} пользователей.", "broadcast")
+                    self.send_message(user, "broadcast_sent", self.get_keyboard("admin", user), {"job_id": job_id, "total": len(recipients)})
             self.actions.pop(user, None)
         elif action == "add_agent":
             try:
@@ -356,7 +2788,7 @@ class SupportBot:
                     self.send_message(user, "already_agent", self.get_keyboard("manage_agents", user), {"agent_id": agent_id})
                 else:
                     self.agents[str(agent_id)] = {"role": role}
-                    self.save_file('candyxpe_agents.json', self.agents)
+                    self.save_agents()
                     self.send_message(user, "agent_added", self.get_keyboard("admin", user), {"role": role.capitalize(), "agent_id": agent_id})
                     self.send_admin(user, f"{role.capitalize()} @id{agent_id} назначен.", "add_agent")
                 self.actions.pop(user, None)
@@ -370,7 +2802,7 @@ class SupportBot:
                 elif str(agent_id) in self.agents:
                     role = self.agents[str(agent_id)]["role"]
                     del self.agents[str(agent_id)]
-                    self.save_file('candyxpe_agents.json', self.agents)
+                    self.save_agents()
                     self.send_message(user, "agent_removed", self.get_keyboard("admin", user), {"role": role.capitalize(), "agent_id": agent_id})
                     self.send_admin(user, f"{role.capitalize()} @id{agent_id} снят.", "remove_agent")
                 else:
@@ -381,12 +2813,16 @@ class SupportBot:
         elif action == "ban":
             try:
                 target_id, hours = map(int, text.split())
+                if not 0 < hours <= BanRegistry.MAX_HOURS:
+                    raise ValueError
                 if target_id == user:
                     self.send_message(user, "self_ban", self.get_keyboard("ban_user", user))
                 elif str(target_id) in self.agents:
                     self.send_message(user, "agent_ban", self.get_keyboard("ban_user", user))
+                elif not self.banned.ban(target_id, hours, user):
+                    until = self.banned.expiry(target_id).strftime('%Y-%m-%d %H:%M')
+                    self.send_message(user, "already_banned", self.get_keyboard("ban_user", user), {"target_id": target_id, "until": until})
                 else:
-                    self.banned[target_id] = datetime.now() + timedelta(hours=hours)
                     self.send_message(user, "banned", self.get_keyboard("ban_user", user), {"target_id": target_id, "hours": hours})
                     self.send_message(target_id, "banned_notify", self.get_keyboard("main", target_id), {"hours": hours})
                     self.send_admin(user, f"id{target_id} забанен на {hours} часов.", "ban")
@@ -396,8 +2832,7 @@ class SupportBot:
         elif action == "unban":
             try:
                 target_id = int(text)
-                if target_id in self.banned:
-                    del self.banned[target_id]
+                if self.banned.unban(target_id, user):
                     self.send_message(user, "unbanned", self.get_keyboard("ban_user", user), {"target_id": target_id})
                     self.send_message(target_id, "unbanned_notify", self.get_keyboard("main", target_id))
                     self.send_admin(user, f"id{target_id} разбанен.", "unban")
@@ -407,59 +2842,170 @@ class SupportBot:
             except ValueError:
                 self.send_message(user, "invalid_id", self.get_keyboard("action", user))
 
-    def check_spam(self, user):
-        now = time.time()
-        self.spam[user] = [t for t in self.spam.get(user, []) if now - t < 60]
-        if len(self.spam[user]) >= 25:
-            logger.warning(f"Пользователь {user} превысил лимит сообщений (спам)")
+    def broadcast_audience(self, segment):
+        if segment == "#agents":
+            return sorted(int(uid) for uid in self.agents)
+        if segment == "#active":
+            if self.shards == 1:
+                return sorted(self.ai_users | self.human_users)
+            return sorted(int(uid) for uid in set(self.store.load("ai_users")) | set(self.store.load("human_users")))
+        return sorted(int(uid) for uid in self.store.load("users"))
+
+    def notify_admin_chat(self, text):
+        try:
+            self.api("messages.send", chat_id=self.admin_chat, message=text, random_id=get_random_id())
+        except Exception as e:
+            logger.error("Ошибка отправки в админ-чат: %s", e)
+
+    def contact_agent(self, user):
+        self.human_users.add(user)
+        self.ai_users.discard(user)
+        ticket, created = self.tickets.open(user)
+        if created:
+            self.send_admin(user, "✱ Пользователь подключён к оператору.", "agent", ticket=ticket)
+        self.send_message(user, "human_on", self.get_keyboard("human", user), {"ticket_id": ticket["id"], "position": self.tickets.position(ticket) or "—"})
+
+    def close_ticket(self, agent, target_id):
+        ticket = self.tickets.close(target_id)
+        if ticket:
+            self.human_users.discard(target_id)
+            self.send_message(agent, "ticket_closed", self.get_keyboard("admin", agent), {"ticket_id": ticket["id"], "target_id": target_id})
+            self.send_message(target_id, "human_off", self.get_keyboard("main", target_id))
+        else:
+            self.send_message(agent, "no_ticket", self.get_keyboard("admin", agent), {"target_id": target_id})
+
+    def leave_human(self, user):
+        self.human_users.discard(user)
+        ticket = self.tickets.close(user)
+        if ticket:
+            self.notify_admin_chat(f"✱ Обращение #{ticket['id']} (@id{user}) закрыто пользователем.")
+
+    def ingest(self, event):
+        if self.recorder:
+            self.recorder.write(event)
+        self.dispatcher.submit(getattr(event, 'user_id', None), event)
+
+    def register_gauges(self):
+        self.metrics.gauge("dispatch_queue_depth", self.dispatcher.pending)
+        self.metrics.gauge("send_queue_depth", self.outbox.queue.qsize)
+        self.metrics.gauge("state_pending_writes", lambda: len(self.store.pending))
+        self.metrics.gauge("tickets_waiting", lambda: len(self.tickets.waiting))
+        self.metrics.gauge("tickets_open", lambda: len(self.tickets.tickets))
+        self.metrics.gauge("sessions_cached", lambda: len(self.sessions))
+        self.metrics.gauge("bans_active", lambda: len(self.banned))
+        self.metrics.gauge("broadcasts_running", lambda: len(self.broadcasts.running()))
+
+    def start_metrics(self):
+        if not self.METRICS_PORT:
+            return
+        port = self.METRICS_PORT + self.shard
+        server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+        server.daemon_threads = True
+        server.metrics = self.metrics
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        logger.info("Метрики доступны на :%s/metrics", port)
+
+    def latency_report(self):
+        lines = []
+        for stage in self.METRIC_STAGES:
+            p50, p99 = self.metrics.quantile(stage, 0.5), self.metrics.quantile(stage, 0.99)
+            if p50 is not None:
+                lines.append(f"{stage}: {p50 * 1000:.0f}/{p99 * 1000:.0f} мс")
+        return "\n".join(lines) or "Нет данных."
+
+    def owns(self, user):
+        return user % self.shards == self.shard
+
+    def notify_unbanned(self, user):
+        if not self.owns(user):
+            return
+        self.send_message(user, "ban_expired_notify", self.get_keyboard("main", user))
+
+    def check_limit(self, user, policy):
+        session = self.sessions.get(user)
+        if self.limiter.muted(session):
+            self.metrics.inc("rate_limited_total", policy=policy)
             return False
-        self.spam[user].append(now)
-        return True
+        if self.limiter.allow(session, policy):
+            return True
+        self.metrics.inc("rate_limited_total", policy=policy)
+        logger.warning("Пользователь %s превысил лимит %s", user, policy)
+        duration = self.limiter.penalize(session)
+        if duration:
+            self.store.put("mutes", user, {"mutes": session.mutes, "until": session.muted_until})
+            logger.warning("Пользователь %s замучен на %s с", user, duration)
+            self.send_message(user, "muted", self.get_keyboard("main", user), {"minutes": max(1, round(duration / 60))})
+        else:
+            self.send_message(user, "rate_limited", self.get_keyboard("main", user))
+        return False
 
+    @timed("process_message")
     def process_message(self, event):
-        if event.type != VkEventType.MESSAGE_NEW or event.from_chat or not event.to_me:
+        if event.type != VkEventType.MESSAGE_NEW or event.from_chat:
+            return
+        if not event.to_me:
+            if not self.is_operator_reply(event):
+                return
+            ticket = self.tickets.respond(event.user_id)
+            if ticket:
+                logger.info("Первый ответ по обращению #%s за %.0f с", ticket['id'], ticket['first_response'] - ticket['created'])
             return
         user = event.user_id
         text = event.text.strip() if event.text else ""
-        logger.debug(f"Начало обработки сообщения от {user}, текст: {text}")
-        self.banned = {uid: expiry for uid, expiry in self.banned.items() if datetime.now() <= expiry}
-        if user in self.banned:
+        logger.debug("Начало обработки сообщения от %s, текст: %s", user, text)
+        if self.banned.is_banned(user):
             self.send_message(user, "banned_user", self.get_keyboard("main", user))
             return
-        if not self.check_spam(user):
-            self.send_message(user, "error", self.get_keyboard("main", user))
+        if not self.check_limit(user, "message"):
             return
-        self.stats["users"].add(user)
-        self.stats["messages"] += 1
+        with self.lock:
+            if self.stats["users"].add(user):
+                self.store.put("stats", self.stat_key("users"), self.stats["users"].registers.hex())
+            self.stats["messages"] += 1
+            self.store.put("stats", self.stat_key("messages"), self.stats["messages"])
         if text.startswith('/'):
-            logger.debug(f"Обработка команды: {text[1:]}")
+            logger.debug("Обработка команды: %s", text[1:])
             self.process_command(user, text[1:])
             return
         if hasattr(event, 'payload') and event.payload:
             try:
                 payload = json.loads(event.payload)
                 if isinstance(payload, dict) and "command" in payload:
-                    logger.debug(f"Обработка payload: {payload}")
+                    logger.debug("Обработка payload: %s", payload)
                     self.process_command(user, payload["command"])
                     return
             except json.JSONDecodeError as e:
-                logger.error(f"Ошибка декодирования payload для {user}: {e}")
+                logger.error("Ошибка декодирования payload для %s: %s", user, e)
                 self.send_message(user, "error", self.get_keyboard("main", user))
                 return
         if not text:
             self.send_message(user, "no_input", self.get_keyboard("main", user))
             return
         if user in self.human_users:
-            attachments = [f"{att['type']}{att[att['type']]['owner_id']}_{att[att['type']]['id']}" for att in event.attachments if att.get('type')] if event.attachments else None
-            self.send_admin(user, text, "agent", ",".join(attachments) if attachments else None)
+            if not self.check_limit(user, "operator"):
+                return
+            ticket = self.tickets.follow_up(user) or self.tickets.open(user)[0]
+            attachments = self.attachments.submit(event.attachments, event.message_id) if event.attachments else None
+            self.after_attachments(user, attachments, lambda attachment: self.send_admin(user, text, "agent", attachment, ticket))
             return
         if user in self.actions:
-            attachments = [f"{att['type']}{att[att['type']]['owner_id']}_{att[att['type']]['id']}" for att in event.attachments if att.get('type')] if event.attachments else None
-            self.process_action(user, self.actions[user], text, ",".join(attachments) if attachments else None)
+            if not self.check_limit(user, "report" if self.actions[user] in ["staff", "bug"] else "admin"):
+                return
+            action = self.actions[user]
+            attachments = self.attachments.submit(event.attachments, event.message_id) if event.attachments and action in ["staff", "bug"] else None
+            self.process_action(user, action, text, attachments)
             return
         if user in self.ai_users:
             if text.lower() in {"выйти", "выход", "стоп"}:
                 self.process_command(user, "end_ai")
+                return
+            if not self.check_limit(user, "ai"):
+                return
+            cached = self.cached_ai_response(user, text)
+            if cached is not None:
+                self.send_message(user, cached, self.get_keyboard("ai", user))
+            elif self.AI_STREAM:
+                self.stream_ai_response(user, text)
             else:
                 response = self.get_ai_response(user, text)
                 self.send_message(user, response, self.get_keyboard("ai", user))
@@ -474,17 +3020,178 @@ class SupportBot:
         print(f"Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         print(f"Техподдержка CandyxPE by vatkovskydev под руководством dsuslov67\n{'-'*40}\n")
         logger.info("Бот запущен")
+        self.start_metrics()
+        self.broadcasts.resume()
+        self.longpoll = self.longpoll or VkLongPoll(self.vk_session)
         while True:
             try:
                 for event in self.longpoll.listen():
-                    self.process_message(event)
+                    self.ingest(event)
+            except KeyboardInterrupt:
+                logger.info("Остановка бота")
+                self.dispatcher.shutdown()
+                self.attachments.shutdown()
+                self.store.close()
+                return
             except Exception as e:
-                logger.error(f"Ошибка в LongPoll: {e}")
+                logger.error("Ошибка в LongPoll: %s", e)
                 time.sleep(1)
 
+    def run_callback(self, host, port, confirmation, secret=None):
+        logger.info("Бот запущен в режиме Callback API на %s:%s", host, port)
+        self.start_metrics()
+        self.broadcasts.resume()
+        server = CallbackServer((host, port), self, confirmation, secret)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Остановка бота")
+        finally:
+            server.server_close()
+            self.dispatcher.shutdown()
+            self.attachments.shutdown()
+            self.store.close()
+
+    def serve_shard(self, events):
+        logger.info("Шард %s/%s запущен", self.shard, self.shards)
+        threading.Thread(target=self.sync_shards, name="shard-sync", daemon=True).start()
+        self.start_metrics()
+        if self.shard == 0:
+            self.broadcasts.resume()
+        while True:
+            try:
+                event = events.get()
+            except KeyboardInterrupt:
+                continue
+            if event is None:
+                break
+            self.ingest(event)
+        self.dispatcher.shutdown()
+        self.attachments.shutdown()
+        self.store.close()
+        logger.info("Шард %s остановлен", self.shard)
+
+    def lift_limits(self):
+        unlimited = {"capacity": 10 ** 9, "per": 1}
+        self.limiter.configure({
+            "policies": {name: unlimited for name in RateLimiter.DEFAULTS["policies"]},
+            "global": {name: unlimited for name in RateLimiter.DEFAULTS["global"]}
+        })
+        self.ai_queue = threading.BoundedSemaphore(self.WORKERS)
+
+    def run_offline(self, events, limits=False):
+        self.outbox.interval = 0
+        if not limits:
+            self.lift_limits()
+        started = time.monotonic()
+        count = 0
+        for event in events:
+            self.ingest(event)
+            count += 1
+        self.dispatcher.shutdown()
+        self.attachments.shutdown()
+        elapsed = time.monotonic() - started
+        calls = getattr(self.vk_session, "calls", Counter())
+        print(f"Событий: {count} за {elapsed:.2f} с ({count / max(elapsed, 1e-9):.0f} событий/с)")
+        print(f"ИИ занят: {self.metrics.total('ai_busy_total')}, отклонено лимитами: {self.metrics.total('rate_limited_total')}, ошибок ИИ: {self.metrics.total('ai_errors_total')}")
+        print(f"HTTP-запросов к VK: {self.outbox.http_calls}, вызовов API: {sum(calls.values())}")
+        for method, total in calls.most_common():
+            print(f"  {method}: {total}")
+        print(self.latency_report())
+        self.store.close()
+
+    @classmethod
+    def run_sharded(cls, token, admin_chat, group, shards, events=None):
+        logger.info("Бот запущен в режиме шардирования: %s процессов", shards)
+        offline = events is not None
+        queues = [multiprocessing.Queue() for _ in range(shards)]
+        workers = [
+            multiprocessing.Process(target=run_shard, args=(token, admin_chat, group, i, shards, queues[i], offline), name=f"shard-{i}")
+            for i in range(shards)
+        ]
+        for worker in workers:
+            worker.start()
+        def route(event):
+            if event.type == VkEventType.MESSAGE_NEW and getattr(event, 'user_id', None):
+                queues[event.user_id % shards].put(snapshot_event(event))
+        started = time.monotonic()
+        count = 0
+        try:
+            if offline:
+                for event in events:
+                    route(event)
+                    count += 1
+            else:
+                longpoll = VkLongPoll(vk_api.VkApi(token=token))
+                while True:
+                    try:
+                        for event in longpoll.listen():
+                            route(event)
+                    except KeyboardInterrupt:
+                        raise
+                    except Exception as e:
+                        logger.error("Ошибка в LongPoll: %s", e)
+                        time.sleep(1)
+        except KeyboardInterrupt:
+            logger.info("Остановка бота")
+        finally:
+            for shard_events in queues:
+                shard_events.put(None)
+            for worker in workers:
+                worker.join()
+        if offline:
+            elapsed = time.monotonic() - started
+            print(f"Шардов: {shards}, событий: {count} за {elapsed:.2f} с ({count / max(elapsed, 1e-9):.0f} событий/с)")
+            return count / max(elapsed, 1e-9)
+
 if __name__ == "__main__":
-    VK_TOKEN = "vk1.a.BfB4WDbOxfqsQLqcONRk3lrcEmTW9BmnMYiU8xLbZKjRUkGDUkdmpvNi2nFMCAzX_lOwYqHBM2VubFepkpraAuBJ50JWXIX0mWfwPbBMbtGbKrOhhZYROaAlkGeqA1L-8Z-aa35kp00rRGjOooH87hoEZmWGxPBhBEg7Q4SC-1S-CoCR2hZp9QEZS7-i8TrfyucOUrFApTJE5N4hhTOG7Q"
-    ADMIN_CHAT_ID = 2
-    GROUP_ID = 230630628
+    parser = argparse.ArgumentParser(description="Техподдержка CandyxPE")
+    parser.add_argument("--record", metavar="PATH", help="записывать входящие события в JSONL")
+    parser.add_argument("--replay", metavar="PATH", help="воспроизвести записанные события без обращения к VK")
+    parser.add_argument("--synthetic", metavar="N", type=int, help="прогнать N синтетических событий без обращения к VK")
+    parser.add_argument("--users", type=int, default=1000, help="число пользователей для --synthetic")
+    parser.add_argument("--seed", type=int, default=0, help="зерно генератора для --synthetic")
+    parser.add_argument("--limits", action="store_true", help="применять боевые лимиты в --replay/--synthetic")
+    parser.add_argument("--shards", type=int, default=1, help="прогнать --replay/--synthetic в N процессах")
+    args = parser.parse_args()
+    CONFIG = load_config()
+    ADMIN_CHAT_ID = CONFIG["admin_chat"]
+    GROUP_ID = CONFIG["group"]
+    if args.replay or args.synthetic:
+        events = replay_events(os.path.abspath(args.replay)) if args.replay else synthetic_events(args.synthetic, args.users, args.seed)
+        rules = os.path.abspath('candyxpe_rules.txt')
+        with tempfile.TemporaryDirectory(prefix="candyxpe-offline-") as workdir:
+            if os.path.exists(rules):
+                shutil.copy(rules, workdir)
+            os.chdir(workdir)
+            if args.shards > 1:
+                if args.synthetic:
+                    atomic_write('candyxpe_agents.json', json.dumps({"1": {"role": "manager"}}))
+                SupportBot.run_sharded(None, ADMIN_CHAT_ID, GROUP_ID, args.shards, events)
+                raise SystemExit
+            SupportBot.STATE_PATH = ":memory:"
+            bot = SupportBot(None, ADMIN_CHAT_ID, GROUP_ID, vk_session=OfflineVk(), ai_backend=offline_ai)
+            if args.synthetic:
+                bot.agents["1"] = {"role": "manager"}
+            bot.run_offline(events, args.limits)
+        raise SystemExit
+    VK_TOKEN = CONFIG.get("token")
+    if not VK_TOKEN:
+        raise SystemExit("Не задан токен: переменная VK_TOKEN или token в candyxpe_config.json")
+    SupportBot.METRICS_PORT = int(os.environ.get("METRICS_PORT", 0)) or None
+    SHARDS = int(os.environ.get("BOT_SHARDS", 1))
+    if SHARDS > 1:
+        SupportBot.run_sharded(VK_TOKEN, ADMIN_CHAT_ID, GROUP_ID, SHARDS)
+        raise SystemExit
     bot = SupportBot(VK_TOKEN, ADMIN_CHAT_ID, GROUP_ID)
-    bot.run()
+    if args.record:
+        bot.recorder = EventRecorder(args.record)
+    if os.environ.get("BOT_MODE") == "callback":
+        bot.run_callback(
+            os.environ.get("CALLBACK_HOST", "0.0.0.0"),
+            int(os.environ.get("CALLBACK_PORT", 8080)),
+            os.environ["CALLBACK_CONFIRMATION"],
+            os.environ.get("CALLBACK_SECRET")
+        )
+    else:
+        bot.run()
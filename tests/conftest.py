@@ -0,0 +1,120 @@
+import json
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qsl
+
+import pytest
+import requests
+import vk_api
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+
+
+def event(user, text="", to_me=True, message_id=None, payload=None, attachments=None, **extra):
+    return SimpleNamespace(
+        type=bot.VkEventType.MESSAGE_NEW, from_chat=False, to_me=to_me, from_me=not to_me, user_id=user,
+        peer_id=user, message_id=message_id, text=text, payload=payload, attachments=attachments, **extra
+    )
+
+
+class LocalAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+
+    def send(self, request, **kwargs):
+        request.url = re.sub(r"^https://[^/]+", self.base, request.url)
+        return super().send(request, **kwargs)
+
+
+class FakeVkHandler(BaseHTTPRequestHandler):
+    ONE_METHOD = re.compile(r"var values = (.*?),\s*i = 0.*?API\.([\w.]+)\(values\[i\]\)", re.S)
+    MANY_METHODS = re.compile(r"API\.([\w.]+)\((\{.*?\})\)(?=,API\.|\];)", re.S)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        values = dict(parse_qsl(body))
+        method = self.path.rsplit("/", 1)[-1]
+        self.server.count(method)
+        if method == "execute":
+            match = self.ONE_METHOD.search(values["code"])
+            if match:
+                calls = [(match.group(2), params) for params in json.loads(match.group(1))]
+            else:
+                calls = [(name, json.loads(params)) for name, params in self.MANY_METHODS.findall(values["code"])]
+            payload = {"response": [self.server.vk.method(name, params) for name, params in calls]}
+        else:
+            payload = {"response": self.server.vk.method(method, values)}
+        data = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeVkServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeVkHandler)
+        self.vk = bot.OfflineVk()
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, method):
+        with self.lock:
+            self.requests[method] += 1
+
+    def session(self):
+        session = vk_api.VkApi(token="fake")
+        session.RPS_DELAY = 0
+        session.http.mount("https://", LocalAdapter(self.url))
+        return session
+
+
+@pytest.fixture
+def fake_vk():
+    server = FakeVkServer()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def make_bot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bot.SupportBot, "STATE_PATH", str(tmp_path / "state.db"))
+    bots = []
+
+    def factory(ai_backend=bot.offline_ai, vk_session=None, **kwargs):
+        instance = bot.SupportBot(None, 2, 1, vk_session=vk_session or bot.OfflineVk(), ai_backend=ai_backend, **kwargs)
+        instance.outbox.interval = 0
+        bots.append(instance)
+        return instance
+
+    yield factory
+    for instance in bots:
+        instance.dispatcher.shutdown()
+        instance.attachments.shutdown()
+        instance.store.close()
+
+
+@pytest.fixture
+def offline_bot(make_bot):
+    return make_bot()
@@ -0,0 +1,31 @@
+import time
+
+from conftest import event
+
+
+def test_admin_forwards_keep_user_order(offline_bot, monkeypatch):
+    sent = []
+    monkeypatch.setattr(offline_bot, "send_admin", lambda user, text, action, attachment=None, ticket=None: sent.append((text, attachment)) or True)
+    forward = offline_bot.attachments._forward
+
+    def slow_forward(*args):
+        time.sleep(0.3)
+        return forward(*args)
+
+    monkeypatch.setattr(offline_bot.attachments, "_forward", slow_forward)
+    offline_bot.contact_agent(9)
+    offline_bot.process_message(event(9, "скриншот", attachments=[{"type": "photo", "photo": {"owner_id": 9, "id": 1, "access_key": "k"}}]))
+    offline_bot.process_message(event(9, "см. выше"))
+    deadline = time.time() + 5
+    while (len(sent) < 3 or offline_bot.forwards) and time.time() < deadline:
+        time.sleep(0.05)
+    assert sent[1:] == [("скриншот", "photo9_1_k"), ("см. выше", None)]
+    assert offline_bot.forwards == {}
+
+
+def test_text_only_forward_is_inline_without_pending_attachments(offline_bot, monkeypatch):
+    sent = []
+    monkeypatch.setattr(offline_bot, "send_admin", lambda user, text, action, attachment=None, ticket=None: sent.append(text) or True)
+    offline_bot.contact_agent(9)
+    offline_bot.process_message(event(9, "вопрос"))
+    assert sent[-1] == "вопрос"
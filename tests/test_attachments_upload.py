@@ -0,0 +1,159 @@
+import hashlib
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import bot
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        content = self.server.files.get(self.path.rsplit("/", 1)[-1])
+        if content is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.server.count("download")
+        self.send_response(200)
+        if not self.path.startswith("/chunked/"):
+            self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        kind = self.path.rsplit("/", 1)[-1]
+        if self.server.broken:
+            self.send_response(500)
+            self.end_headers()
+            return
+        files = body.count(b'filename="')
+        self.server.count(f"upload_{kind}", files)
+        digests = [hashlib.sha256(part).hexdigest()[:8] for part in body.split(b"\r\n\r\n")[1:]]
+        payload = {"server": 1, "photo": json.dumps(digests[:files]), "hash": "h"} if kind == "photo" else {"file": digests[0]}
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MediaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), MediaHandler)
+        self.files = {}
+        self.requests = Counter()
+        self.broken = False
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, kind, value=1):
+        with self.lock:
+            self.requests[kind] += value
+
+
+class MediaVk(bot.OfflineVk):
+    def __init__(self, media):
+        super().__init__()
+        self.media = media
+        self.saved = 0
+
+    def method(self, method, values=None):
+        values = values or {}
+        if method in ("photos.getMessagesUploadServer", "docs.getMessagesUploadServer"):
+            kind = "photo" if method.startswith("photos") else "doc"
+            return {"upload_url": f"{self.media.url}/upload/{kind}"}
+        if method == "photos.saveMessagesPhoto":
+            with self.lock:
+                self.saved += 1
+            return [{"id": int(digest, 16), "owner_id": -1, "access_key": "k"} for digest in json.loads(values["photo"])]
+        if method == "docs.save":
+            return {"type": "doc", "doc": {"id": int(values["file"], 16), "owner_id": -1}}
+        return super().method(method, values)
+
+
+@pytest.fixture
+def media():
+    server = MediaServer()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def pipeline(make_bot, fake_vk, media):
+    fake_vk.vk = MediaVk(media)
+    return make_bot(vk_session=fake_vk.session()).attachments
+
+
+def photo(media, name, content, owner=9, id=1):
+    media.files[name] = content
+    return {"type": "photo", "photo": {"owner_id": owner, "id": id, "sizes": [{"width": 10, "height": 10, "url": f"{media.url}/files/{name}"}]}}
+
+
+def doc(media, name, content, size=None, path="files"):
+    media.files[name] = content
+    return {"type": "doc", "doc": {"owner_id": 9, "id": 2, "url": f"{media.url}/{path}/{name}", "ext": "txt", "title": name, "size": size}}
+
+
+def test_same_content_is_uploaded_once(pipeline, media):
+    attachments = [photo(media, "a.jpg", b"screenshot", id=1), photo(media, "b.jpg", b"screenshot", id=2)]
+    first = pipeline.submit(attachments).result(timeout=10)
+    second = pipeline.submit([photo(media, "c.jpg", b"screenshot", id=3)]).result(timeout=10)
+    assert first.split(",")[0].startswith("photo-1_")
+    assert media.requests["upload_photo"] == 1
+    assert first.split(",") == [second, second]
+    assert pipeline.metrics.total("attachments_total") == 3
+    assert dict(pipeline.metrics.counters)[("attachments_total", (("result", "cached"),))] == 2
+
+
+def test_oversized_files_fall_back_to_reference(pipeline, media, monkeypatch):
+    monkeypatch.setattr(pipeline, "MAX_SIZE", 100)
+    declared = doc(media, "declared.txt", b"x" * 10, size=1000)
+    header = doc(media, "header.txt", b"x" * 1000)
+    streamed = doc(media, "streamed.txt", b"x" * 1000, path="chunked")
+    small = doc(media, "small.txt", b"x" * 10)
+    result = pipeline.submit([declared, header, streamed, small]).result(timeout=10)
+    refs = result.split(",")
+    assert refs[:3] == ["doc9_2"] * 3
+    assert refs[3].startswith("doc-1_")
+    assert media.requests["download"] == 3
+    assert media.requests["upload_doc"] == 1
+
+
+def test_failures_fall_back_to_reference(pipeline, media):
+    missing = {"type": "photo", "photo": {"owner_id": 9, "id": 5, "access_key": "k", "sizes": [{"url": f"{media.url}/files/missing.jpg"}]}}
+    wall = {"type": "wall", "wall": {"owner_id": 9, "id": 6}}
+    assert pipeline.submit([missing, wall]).result(timeout=10) == "photo9_5_k,wall9_6"
+    media.broken = True
+    assert pipeline.submit([photo(media, "d.jpg", b"new", id=7)]).result(timeout=10) == "photo9_7"
+    assert dict(pipeline.metrics.counters)[("attachments_total", (("result", "failed"),))] == 2
+
+
+def test_forward_benchmark(pipeline, media):
+    reports = 50
+    started = time.perf_counter()
+    futures = [
+        pipeline.submit([photo(media, f"r{i}-{j}.jpg", (b"%d" % ((i * 3 + j) % 60)) * 20000, id=j) for j in range(3)])
+        for i in range(reports)
+    ]
+    results = [future.result(timeout=60) for future in futures]
+    elapsed = time.perf_counter() - started
+    print(f"{reports} обращений по 3 фото: {elapsed:.2f}с ({elapsed / reports * 1000:.0f} мс на обращение), "
+          f"скачиваний {media.requests['download']}, загружено фото {media.requests['upload_photo']}, "
+          f"из кэша {dict(pipeline.metrics.counters).get(('attachments_total', (('result', 'cached'),)), 0)}")
+    assert all(len(result.split(",")) == 3 for result in results)
+    assert media.requests["upload_photo"] <= 64
@@ -0,0 +1,89 @@
+import time
+
+import pytest
+
+from conftest import event
+
+import bot
+
+
+def test_out_of_range_ban_changes_nothing(offline_bot):
+    with pytest.raises(ValueError):
+        offline_bot.banned.ban(5, 10 ** 12, by=1)
+    assert not offline_bot.banned.is_banned(5)
+    assert offline_bot.banned.heap == []
+    assert offline_bot.banned.history.get(5) is None
+
+
+def test_ban_action_rejects_huge_hours(offline_bot):
+    offline_bot.agents["1"] = {"role": "manager"}
+    offline_bot.actions[1] = "ban"
+    offline_bot.process_message(event(1, f"5 {10 ** 12}"))
+    assert not offline_bot.banned.is_banned(5)
+    assert offline_bot.actions.get(1) == "ban"
+
+
+@pytest.fixture
+def registry(tmp_path):
+    expired = []
+    store = bot.JournalStateStore(str(tmp_path / "state.json"))
+    registry = bot.BanRegistry(store, on_expire=expired.append)
+    registry.expired = expired
+    yield registry
+    store.close()
+
+
+def test_expired_ban_notifies_and_records_lift(registry):
+    assert registry.ban(5, 0.05 / 3600, by=1)
+    assert registry.is_banned(5)
+    deadline = time.monotonic() + 2
+    while not registry.expired and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert registry.expired == [5]
+    assert not registry.is_banned(5) and registry.heap == []
+    record = registry.records(5)[0]
+    assert record["by"] == 1 and record["lifted_by"] is None and record["lifted"] >= record["until"]
+
+
+def test_overlapping_ban_is_rejected(registry):
+    assert registry.ban(5, 2, by=1)
+    expiry = registry.expiry(5)
+    assert not registry.ban(5, 48, by=2)
+    assert registry.expiry(5) == expiry
+    assert len(registry.records(5)) == 1
+
+
+def test_history_keeps_every_ban_and_unban(registry):
+    registry.ban(5, 2, by=1)
+    assert registry.unban(5, by=3)
+    assert not registry.unban(5, by=3)
+    registry.ban(5, 1, by=4)
+    first, second = registry.records(5)
+    assert (first["by"], first["lifted_by"]) == (1, 3)
+    assert second["by"] == 4 and "lifted" not in second
+    assert registry.store.get("bans", 5) is not None
+
+
+def test_ban_notification_reaches_user(offline_bot):
+    offline_bot.banned.ban(5, 0.05 / 3600, by=1)
+    deadline = time.monotonic() + 2
+    while offline_bot.banned.is_banned(5) or offline_bot.vk_session.calls["messages.send"] == 0:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert offline_bot.banned.store.get("bans", 5) is None
+
+
+def test_ban_check_cost_does_not_grow_with_active_bans(registry):
+    checks = 200000
+    now = time.time()
+    results = {}
+    for size in (10000, 100000, 1000000):
+        for uid in range(len(registry), size):
+            registry.apply_ban(uid, now + 3600 + uid)
+        users = [uid * 7 % (2 * size) for uid in range(checks)]
+        started = time.perf_counter()
+        for uid in users:
+            registry.is_banned(uid)
+        results[size] = (time.perf_counter() - started) / checks * 1e9
+    print("нс на проверку блокировки: " + ", ".join(f"{size}: {cost:.0f}" for size, cost in results.items()))
+    assert results[1000000] < results[10000] * 3
@@ -0,0 +1,103 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import bot
+
+
+class RecordingOutbox:
+    BATCH_SIZE = bot.SendQueue.BATCH_SIZE
+
+    def __init__(self, block_after=None):
+        self.calls = []
+        self.block_after = block_after
+        self.lock = threading.Lock()
+
+    def call(self, method, params, wait=True):
+        with self.lock:
+            self.calls.append(params)
+            blocked = self.block_after is not None and len(self.calls) > self.block_after
+        future = Future()
+        if not blocked:
+            future.set_result([{"peer_id": int(peer), "message_id": 1} for peer in params["peer_ids"].split(",")])
+        return future
+
+
+def wait_done(store, job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while store.get("broadcasts", job_id, {}).get("status") != "done":
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return store.get("broadcasts", job_id)
+
+
+def test_segments_select_audience(offline_bot):
+    for uid in range(1, 6):
+        offline_bot.store.put("users", uid, 0)
+    offline_bot.agents["10"] = {"role": "admin"}
+    offline_bot.ai_users.add(2)
+    offline_bot.human_users.add(3)
+    assert offline_bot.broadcast_audience("#all") == [1, 2, 3, 4, 5]
+    assert offline_bot.broadcast_audience("#agents") == [10]
+    assert offline_bot.broadcast_audience("#active") == [2, 3]
+
+
+def test_banned_users_are_excluded(offline_bot):
+    sent = []
+    notices = []
+    offline_bot.broadcasts.outbox = RecordingOutbox()
+    offline_bot.broadcasts.notify = notices.append
+    for uid in range(1, 6):
+        offline_bot.store.put("users", uid, 0)
+    offline_bot.agents["10"] = {"role": "admin"}
+    offline_bot.banned.ban(4, 1, by=10)
+    offline_bot.process_action(10, "broadcast", "#all Вайп в субботу")
+    job_id = next(iter(offline_bot.store.load("broadcasts")))
+    job = wait_done(offline_bot.store, job_id)
+    for params in offline_bot.broadcasts.outbox.calls:
+        sent.extend(int(peer) for peer in params["peer_ids"].split(","))
+    assert sent == [1, 2, 3, 5]
+    assert (job["sent"], job["failed"], job["segment"]) == (4, 0, "#all")
+    assert "Вайп в субботу" in offline_bot.broadcasts.outbox.calls[0]["message"]
+    assert notices[-1].startswith(f"📢 Рассылка #{job_id} завершена: доставлено 4 из 4")
+
+
+def test_interrupted_job_resumes_from_checkpoint_with_same_random_ids(tmp_path):
+    path = str(tmp_path / "state.json")
+    recipients = list(range(1, 5001))
+    store = bot.JournalStateStore(path)
+    outbox = RecordingOutbox(block_after=bot.SendQueue.BATCH_SIZE)
+    job_id = bot.BroadcastJobs(store, outbox, lambda text: None).start("Тест", recipients, 1, "#all")
+    deadline = time.monotonic() + 5
+    while store.get("broadcasts", job_id)["offset"] == 0:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    store.flush()
+
+    restarted = bot.JournalStateStore(path)
+    resumed = RecordingOutbox()
+    jobs = bot.BroadcastJobs(restarted, resumed, lambda text: None)
+    jobs.resume()
+    job = wait_done(restarted, job_id)
+    checkpoint = bot.BroadcastJobs.PEERS_PER_CALL * bot.SendQueue.BATCH_SIZE
+    assert resumed.calls[0]["peer_ids"].split(",")[0] == str(recipients[checkpoint])
+    assert sum(len(params["peer_ids"].split(",")) for params in resumed.calls) == len(recipients) - checkpoint
+    assert resumed.calls[0]["random_id"] == outbox.calls[bot.SendQueue.BATCH_SIZE]["random_id"]
+    assert len({params["random_id"] for params in outbox.calls + resumed.calls}) == len(recipients) // bot.BroadcastJobs.PEERS_PER_CALL
+    assert (job["sent"], job["failed"], job["offset"]) == (len(recipients), 0, len(recipients))
+    assert restarted.get("broadcast_recipients", job_id) is None
+    restarted.close()
+
+
+def test_broadcast_to_100k_recipients(fake_vk, tmp_path):
+    store = bot.JournalStateStore(str(tmp_path / "state.json"))
+    jobs = bot.BroadcastJobs(store, bot.SendQueue(fake_vk.session(), rps=20), lambda text: None)
+    started = time.perf_counter()
+    job_id = jobs.start("Плановые работы", list(range(1, 100001)), 1, "#all")
+    job = wait_done(store, job_id, timeout=120)
+    elapsed = time.perf_counter() - started
+    store.close()
+    print(f"рассылка на 100000 получателей: {elapsed:.1f}с, HTTP-запросов {sum(fake_vk.requests.values())}, "
+          f"вызовов messages.send {fake_vk.vk.calls['messages.send']}, {job['sent'] / elapsed:.0f} получателей/с")
+    assert job["sent"] == 100000 and job["failed"] == 0
+    assert set(fake_vk.requests) == {"execute"} and fake_vk.requests["execute"] <= 80
@@ -0,0 +1,90 @@
+import os
+import re
+
+import bot
+
+QUESTIONS = os.path.join(os.path.dirname(__file__), "fixtures", "questions.txt")
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_exact_and_fuzzy_hits_are_counted():
+    cache = bot.AnswerCache()
+    cache.put("Как получить разбан на сервере?", "Через поддержку")
+    assert cache.get("как получить РАЗБАН на сервере") == "Через поддержку"
+    assert cache.get("Как получить разбан на сервере пожалуйста") == "Через поддержку"
+    assert cache.get("Где скачать клиент?") is None
+    assert (cache.hits, cache.fuzzy_hits, cache.misses) == (2, 1, 1)
+    assert abs(cache.hit_rate() - 2 / 3) < 1e-9
+
+
+def test_fuzzy_match_requires_same_rule_numbers():
+    cache = bot.AnswerCache()
+    cache.put("Что написано в пункте 3.1 правил?", "Пункт 3.1 запрещает читы")
+    assert cache.get("Что написано в пункте 3.2 правил?") is None
+    assert cache.get("Что написано в пункте 31 правил?") is None
+    assert cache.get("что написано в пункте 3.1 правил сервера") == "Пункт 3.1 запрещает читы"
+    assert cache.fuzzy_hits == 1
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot.time, "time", clock)
+    cache = bot.AnswerCache(ttl=60)
+    cache.put("Как получить разбан?", "Через поддержку")
+    clock.now += 59
+    assert cache.get("Как получить разбан?") == "Через поддержку"
+    clock.now += 2
+    assert cache.get("Как получить разбан?") is None
+    assert not cache.entries and not cache.index
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = bot.AnswerCache(max_size=2, threshold=1)
+    cache.put("первый вопрос", "1")
+    cache.put("второй вопрос", "2")
+    assert cache.get("первый вопрос") == "1"
+    cache.put("третий вопрос", "3")
+    assert cache.get("второй вопрос") is None
+    assert cache.get("первый вопрос") == "1"
+    assert cache.get("третий вопрос") == "3"
+    assert all(keys <= set(cache.entries) for keys in cache.index.values())
+
+
+def test_rules_change_invalidates_answers(offline_bot, tmp_path):
+    (tmp_path / "candyxpe_rules.txt").write_text("1. Старое правило", encoding="utf-8")
+    offline_bot.refresh_rules()
+    offline_bot.answers.put("Как получить разбан?", "Старый ответ")
+    offline_bot.refresh_rules()
+    assert offline_bot.answers.get("Как получить разбан?") == "Старый ответ"
+    (tmp_path / "candyxpe_rules.txt").write_text("1. Новое правило", encoding="utf-8")
+    os.utime(tmp_path / "candyxpe_rules.txt", (2000, 2000))
+    offline_bot.refresh_rules()
+    assert offline_bot.answers.get("Как получить разбан?") is None
+
+
+def test_replay_question_log_avoids_provider_calls(make_bot):
+    calls = []
+
+    def backend(name, messages, stream=False):
+        calls.append(messages[-1]["content"])
+        return bot.offline_ai(name, messages, delay=0)
+
+    instance = make_bot(ai_backend=backend)
+    with open(QUESTIONS, encoding="utf-8") as f:
+        questions = [line.strip() for line in f if line.strip()]
+    for user, question in enumerate(questions, 1):
+        answer = instance.cached_ai_response(user, question) or instance.get_ai_response(user, question)
+        asked = re.findall(r"\d+", question)
+        assert re.findall(r"\d+", answer.split("«")[1]) == asked
+    avoided = 1 - len(calls) / len(questions)
+    print(f"вопросов: {len(questions)}, вызовов провайдера: {len(calls)}, сэкономлено: {avoided:.0%}, "
+          f"из них по похожести: {instance.answers.fuzzy_hits}")
+    assert avoided >= 0.5
+    assert instance.answers.fuzzy_hits > 0
@@ -0,0 +1,108 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import urllib.error
+import urllib.request
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def servers(make_bot):
+    started = []
+
+    def factory(count, secret=None):
+        for _ in range(count):
+            instance = make_bot()
+            server = bot.CallbackServer(("127.0.0.1", 0), instance, "confirm", secret)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            started.append(server)
+        return started
+
+    yield factory
+    for server in started:
+        server.shutdown()
+        server.server_close()
+
+
+def post(server, body):
+    request = urllib.request.Request(f"http://127.0.0.1:{server.server_port}/", data=json.dumps(body).encode(), method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode()
+
+
+def test_retry_on_another_worker_is_dropped(servers, monkeypatch):
+    first, second = servers(2)
+    received = []
+    for server in (first, second):
+        monkeypatch.setattr(server.bot, "ingest", received.append)
+    body = {"type": "message_new", "group_id": 1, "event_id": "abc", "object": {"message": {"from_id": 5, "peer_id": 5, "id": 1, "text": "привет"}}}
+    assert post(first, body) == (200, "ok")
+    assert post(second, body) == (200, "ok")
+    assert len(received) == 1
+
+
+def test_non_object_body_is_rejected(servers):
+    server, = servers(1)
+    assert post(server, [1, 2])[0] == 400
+
+
+def test_confirmation_returns_configured_string(servers):
+    server, = servers(1, secret="s3cret")
+    assert post(server, {"type": "confirmation", "group_id": 1, "secret": "s3cret"}) == (200, "confirm")
+
+
+def test_bad_secret_or_group_is_forbidden(servers, monkeypatch):
+    server, = servers(1, secret="s3cret")
+    received = []
+    monkeypatch.setattr(server.bot, "ingest", received.append)
+    message = {"message": {"from_id": 5, "peer_id": 5, "id": 1, "text": "привет"}}
+    assert post(server, {"type": "message_new", "group_id": 1, "secret": "wrong", "object": message})[0] == 403
+    assert post(server, {"type": "message_new", "group_id": 2, "secret": "s3cret", "object": message})[0] == 403
+    assert post(server, {"type": "confirmation", "group_id": 1})[0] == 403
+    assert received == []
+    assert post(server, {"type": "message_new", "group_id": 1, "secret": "s3cret", "object": message}) == (200, "ok")
+    assert len(received) == 1
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+def processed_events(instance):
+    with instance.metrics.lock:
+        return instance.metrics.histograms.get("process_message", [None, 0.0, 0])[2]
+
+
+def test_callback_load(servers):
+    server, = servers(1)
+    bodies = [
+        {"type": "message_new", "group_id": 1, "event_id": f"load-{i}",
+         "object": {"message": {"from_id": e.user_id, "peer_id": e.user_id, "id": i, "text": e.text, "payload": e.payload}}}
+        for i, e in enumerate(bot.synthetic_events(3000, users=500))
+    ]
+
+    def timed_post(body):
+        started = time.perf_counter()
+        assert post(server, body) == (200, "ok")
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(16) as pool:
+        latencies = list(pool.map(timed_post, bodies))
+    elapsed = time.perf_counter() - started
+    deadline = time.monotonic() + 60
+    while processed_events(server.bot) < len(bodies):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    processed = time.perf_counter() - started
+    print(f"Callback API: {len(bodies) / elapsed:.0f} событий/с на приёме, {len(bodies) / processed:.0f} событий/с с обработкой, "
+          f"подтверждение p50 {percentile(latencies, 0.5) * 1000:.1f} мс, p99 {percentile(latencies, 0.99) * 1000:.1f} мс")
+    assert percentile(latencies, 0.99) < 0.5
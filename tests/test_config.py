@@ -0,0 +1,52 @@
+import json
+import time
+
+import pytest
+
+import bot
+
+
+def test_reload_keeps_env_overrides(offline_bot, monkeypatch):
+    monkeypatch.setenv("ADMIN_CHAT_ID", "5")
+    offline_bot.apply_config({"admin_chat": 9, "group": 3})
+    assert offline_bot.admin_chat == 5
+    assert offline_bot.attachments.peer_id == 2000000005
+    assert offline_bot.group == 3
+
+
+def test_default_files_hold_overrides_only(offline_bot):
+    for path in ("candyxpe_messages.json", "candyxpe_limits.json"):
+        with open(path, encoding="utf-8") as f:
+            assert json.load(f) == {}
+    assert offline_bot.catalog.text("welcome") == bot.SupportBot.MESSAGES["welcome"]
+
+
+def test_bad_template_fails_load_and_keeps_catalog(offline_bot):
+    with pytest.raises(ValueError):
+        offline_bot.catalog.load({"messages": {"muted": "{unknown}"}})
+    assert offline_bot.catalog.render("muted", {"minutes": 3}) == bot.SupportBot.MESSAGES["muted"].format(minutes=3)
+
+
+def test_keyboard_file_overrides_single_mode(offline_bot):
+    with open("candyxpe_keyboards.json", encoding="utf-8") as f:
+        assert json.load(f) == {}
+    offline_bot.keyboards.load({"ai": [[["end_ai", "СТОП", "negative"]]]})
+    assert "СТОП" in offline_bot.keyboards.get("ai")
+    assert offline_bot.keyboards.get("admin") == bot.KeyboardRegistry().get("admin")
+
+
+def test_message_rendering_throughput():
+    catalog = bot.MessageCatalog(bot.SupportBot.MESSAGES, bot.SupportBot.PREFIXES, bot.SupportBot.PROMPT)
+    renders = 200000
+    rates = {}
+    for name, key, info in (("статичный", "welcome", None), ("с подстановкой", "muted", {"minutes": 3})):
+        started = time.perf_counter()
+        for _ in range(renders):
+            catalog.render(key, info)
+        rates[name] = renders / (time.perf_counter() - started)
+    started = time.perf_counter()
+    catalog.load({"messages": {"welcome": "Привет!"}})
+    reload = time.perf_counter() - started
+    print("рендеров/с: " + ", ".join(f"{name} {rate / 1e6:.1f}M" for name, rate in rates.items()) + f", перезагрузка каталога {reload * 1000:.1f} мс")
+    assert catalog.render("welcome") == "Привет!"
+    assert min(rates.values()) > 200000
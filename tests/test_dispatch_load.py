@@ -0,0 +1,60 @@
+import functools
+import time
+
+import bot
+from conftest import event
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+class TimedVk(bot.OfflineVk):
+    def __init__(self):
+        super().__init__()
+        self.replies = {}
+
+    def method(self, method, values=None):
+        if method == "messages.send" and "user_id" in (values or {}):
+            self.replies.setdefault(values["user_id"], time.monotonic())
+        return super().method(method, values)
+
+
+class FakeLongPoll:
+    def __init__(self, events, interval=0.002):
+        self.events = events
+        self.interval = interval
+        self.sent = {}
+
+    def listen(self):
+        for item in self.events:
+            if item.text == "Начать":
+                self.sent[item.user_id] = time.monotonic()
+            yield item
+            time.sleep(self.interval)
+        raise KeyboardInterrupt
+
+
+def non_ai_latency(make_bot, ai_users):
+    vk = TimedVk()
+    instance = make_bot(ai_backend=functools.partial(bot.offline_ai, delay=1.0), vk_session=vk)
+    events = []
+    for user in range(1000, 1000 + ai_users):
+        instance.ai_users.add(user)
+        events.append(event(user, "Как получить разбан?"))
+    events += [event(user, "Начать") for user in range(1, 201)]
+    longpoll = FakeLongPoll(events)
+    instance.longpoll = longpoll
+    instance.run()
+    latencies = [vk.replies[user] - sent for user, sent in longpoll.sent.items()]
+    return percentile(latencies, 0.5), percentile(latencies, 0.99), instance.metrics.quantile("get_ai_response", 0.5)
+
+
+def test_non_ai_latency_stays_flat_under_ai_saturation(make_bot):
+    idle = non_ai_latency(make_bot, 0)
+    saturated = non_ai_latency(make_bot, 40)
+    print(f"p50/p99 без ИИ-нагрузки: {idle[:2]}, при насыщении ИИ: {saturated[:2]}")
+    assert saturated[2] >= 1.0
+    assert saturated[0] < 0.1
+    assert saturated[1] < 0.25
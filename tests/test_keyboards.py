@@ -0,0 +1,41 @@
+import json
+import time
+
+import bot
+
+
+def legacy_keyboard(mode, agent):
+    keyboards = {
+        name: [[bot.KeyboardRegistry.button(*button) for button in row] for row in rows]
+        for name, rows in bot.KeyboardRegistry.DEFAULTS.items() if name != "agent_rows"
+    }
+    buttons = keyboards.get(mode, keyboards["main"])
+    if agent and mode == "main":
+        buttons.insert(0, [bot.KeyboardRegistry.button(*bot.KeyboardRegistry.DEFAULTS["agent_rows"]["main"][0][0])])
+    return json.dumps({"one_time": False, "buttons": buttons}, ensure_ascii=False)
+
+
+def test_prebuilt_keyboards_match_per_reply_serialization(offline_bot):
+    offline_bot.agents["7"] = {"role": "agent"}
+    for mode in ("main", "ai", "human", "action", "admin", "manage_agents", "ban_user"):
+        assert json.loads(offline_bot.get_keyboard(mode, 5)) == json.loads(legacy_keyboard(mode, False))
+        assert json.loads(offline_bot.get_keyboard(mode, 7)) == json.loads(legacy_keyboard(mode, True))
+    assert offline_bot.get_keyboard("unknown", 5) == offline_bot.get_keyboard("main", 5)
+
+
+def test_per_reply_keyboard_cost(offline_bot):
+    offline_bot.agents["7"] = {"role": "agent"}
+    replies = 20000
+    modes = [("main", 5), ("ai", 5), ("main", 7), ("admin", 7)]
+    started = time.perf_counter()
+    for i in range(replies):
+        mode, user = modes[i % len(modes)]
+        legacy_keyboard(mode, user == 7)
+    before = (time.perf_counter() - started) / replies * 1e6
+    started = time.perf_counter()
+    for i in range(replies):
+        mode, user = modes[i % len(modes)]
+        offline_bot.get_keyboard(mode, user)
+    after = (time.perf_counter() - started) / replies * 1e6
+    print(f"клавиатура на ответ: сборка и json.dumps {before:.1f} мкс, готовая строка {after:.2f} мкс")
+    assert after * 10 < before
@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+import bot
+
+
+def test_mute_survives_session_eviction(offline_bot):
+    offline_bot.limiter.configure({"policies": {"message": {"capacity": 1, "per": 3600}}, "mute": {"strikes": 1}})
+    assert offline_bot.check_limit(5, "message")
+    assert not offline_bot.check_limit(5, "message")
+    muted_until = offline_bot.sessions.get(5).muted_until
+    assert muted_until > time.time()
+    offline_bot.sessions.sessions.clear()
+    session = offline_bot.sessions.get(5)
+    assert session.muted_until == muted_until
+    assert session.mutes == 1
+    assert not offline_bot.check_limit(5, "message")
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot.time, "time", clock)
+    monkeypatch.setattr(bot.time, "monotonic", clock)
+    return clock
+
+
+def test_policy_buckets_refill_independently(clock):
+    limiter = bot.RateLimiter({"policies": {"message": {"capacity": 3, "per": 60}, "report": {"capacity": 1, "per": 600}}})
+    session = bot.UserSession([])
+    assert [limiter.allow(session, "message") for _ in range(4)] == [True, True, True, False]
+    assert limiter.allow(session, "report")
+    assert not limiter.allow(session, "report")
+    clock.now += 20
+    assert limiter.allow(session, "message")
+    assert not limiter.allow(session, "message")
+    assert not limiter.allow(session, "report")
+    clock.now += 600
+    assert [limiter.allow(session, "message") for _ in range(4)] == [True, True, True, False]
+    assert limiter.allow(bot.UserSession([]), "message")
+
+
+def test_global_bucket_is_shared_by_all_users(clock):
+    limiter = bot.RateLimiter({"global": {"ai": {"capacity": 2, "per": 10}}})
+    assert limiter.allow_global("ai") and limiter.allow_global("ai")
+    assert not limiter.allow_global("ai")
+    assert limiter.allow_global("message")
+    clock.now += 5
+    assert limiter.allow_global("ai")
+    assert not limiter.allow_global("ai")
+
+
+def test_mutes_escalate_up_to_max(clock):
+    limiter = bot.RateLimiter({"mute": {"strikes": 2, "window": 300, "base": 60, "max": 200}})
+    session = bot.UserSession([])
+    durations = []
+    for _ in range(4):
+        durations.append((limiter.penalize(session), limiter.penalize(session)))
+        assert limiter.muted(session) == durations[-1][1]
+        clock.now += durations[-1][1]
+        assert not limiter.muted(session)
+    assert durations == [(0, 60), (0, 120), (0, 200), (0, 200)]
+    limiter.penalize(session)
+    clock.now += 301
+    assert limiter.penalize(session) == 0
+
+
+def test_limit_cost_does_not_grow_with_history():
+    limiter = bot.RateLimiter()
+    session = bot.UserSession([])
+    costs = {}
+    events = 0
+    for history in (100, 10000, 1000000):
+        while events < history:
+            limiter.allow(session, "message")
+            events += 1
+        started = time.perf_counter()
+        for _ in range(20000):
+            limiter.allow(session, "message")
+            limiter.allow_global("ai")
+        costs[history] = (time.perf_counter() - started) / 20000 * 1e9
+        events += 20000
+    print("нс на проверку лимитов после N событий: " + ", ".join(f"{history}: {cost:.0f}" for history, cost in costs.items()))
+    assert costs[1000000] < costs[100] * 2
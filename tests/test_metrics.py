@@ -0,0 +1,99 @@
+import functools
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import bot
+
+
+def counter(metrics, name, **labels):
+    return metrics.counters[(name, tuple(sorted(labels.items())))]
+
+
+def test_render_counters_histograms_and_gauges():
+    metrics = bot.Metrics()
+    metrics.inc("ai_errors_total", kind="timeout")
+    metrics.inc("ai_errors_total", 2, kind="unavailable")
+    metrics.inc("messages_total")
+    metrics.observe("send", 0.003)
+    metrics.observe("send", 0.2)
+    metrics.gauge("queue_depth", lambda: 5)
+    metrics.gauge("broken", lambda: 1 / 0)
+    lines = metrics.render().splitlines()
+    assert lines.count("# TYPE candyx_ai_errors_total counter") == 1
+    assert 'candyx_ai_errors_total{kind="timeout"} 1' in lines
+    assert 'candyx_ai_errors_total{kind="unavailable"} 2' in lines
+    assert "candyx_messages_total 1" in lines
+    assert "# TYPE candyx_stage_seconds histogram" in lines
+    assert 'candyx_stage_seconds_bucket{stage="send",le="0.005"} 1' in lines
+    assert 'candyx_stage_seconds_bucket{stage="send",le="0.25"} 2' in lines
+    assert 'candyx_stage_seconds_bucket{stage="send",le="+Inf"} 2' in lines
+    assert 'candyx_stage_seconds_count{stage="send"} 2' in lines
+    assert "# TYPE candyx_queue_depth gauge" in lines
+    assert "candyx_queue_depth 5" in lines
+    assert not any("broken" in line for line in lines)
+
+
+def test_blocking_timeout_counted_separately_from_errors():
+    slow = functools.partial(bot.offline_ai, delay=0.5)
+    metrics = bot.Metrics()
+    pool = bot.ProviderPool(("a",), slow, metrics, timeout=0.1)
+    assert pool.complete([{"role": "user", "content": "?"}]) is None
+    assert counter(metrics, "ai_errors_total", kind="timeout") == 1
+
+    def broken(name, messages, stream=False):
+        raise ConnectionError(f"{name} недоступен")
+
+    metrics = bot.Metrics()
+    pool = bot.ProviderPool(("a", "b"), broken, metrics, timeout=2)
+    assert pool.complete([{"role": "user", "content": "?"}]) is None
+    assert counter(metrics, "ai_errors_total", kind="timeout") == 0
+
+
+def test_ai_timeout_reported_on_blocking_path(make_bot):
+    instance = make_bot(ai_backend=functools.partial(bot.offline_ai, delay=0.5))
+    instance.providers.timeout = 0.1
+    instance.get_ai_response(7, "Что такое пункт 1?")
+    assert counter(instance.metrics, "ai_errors_total", kind="timeout") == 1
+    assert counter(instance.metrics, "ai_errors_total", kind="unavailable") == 1
+
+
+def test_cache_hits_exported_as_counters(offline_bot):
+    question = "Сколько длится блокировка за читы?"
+    assert offline_bot.cached_ai_response(7, question) is None
+    offline_bot.answers.put(question, "30 дней.")
+    assert offline_bot.cached_ai_response(8, question) == "30 дней."
+    lines = offline_bot.metrics.render().splitlines()
+    assert "# TYPE candyx_ai_cache_hits_total counter" in lines
+    assert "candyx_ai_cache_hits_total 1" in lines
+    assert "# TYPE candyx_ai_cache_misses_total counter" in lines
+    assert "candyx_ai_cache_misses_total 1" in lines
+    assert not any(line.startswith("# TYPE candyx_ai_cache") and line.endswith("gauge") for line in lines)
+
+
+@pytest.fixture
+def metrics_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), bot.MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = bot.Metrics()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_metrics_handler_serves_render(metrics_server):
+    metrics_server.metrics.inc("messages_total", 3)
+    url = f"http://127.0.0.1:{metrics_server.server_address[1]}"
+    with urllib.request.urlopen(url + "/metrics?format=text") as response:
+        assert response.status == 200
+        assert response.headers["Content-Type"].startswith("text/plain")
+        body = response.read().decode()
+    assert body == metrics_server.metrics.render()
+    assert "candyx_messages_total 3" in body.splitlines()
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(url + "/health")
+    assert error.value.code == 404
@@ -0,0 +1,91 @@
+import itertools
+import threading
+import time
+
+import bot
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+class FakeProviders:
+    def __init__(self, slow_every=20, slow=1.0, fast=0.01, broken=(), lagging=()):
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+        self.slow_every = slow_every
+        self.slow = slow
+        self.fast = fast
+        self.broken = set(broken)
+        self.lagging = set(lagging)
+
+    def delay(self, name):
+        with self.lock:
+            call = next(self.counter)
+        if name in self.broken:
+            raise ConnectionError(f"{name} недоступен")
+        return self.slow if name in self.lagging or call % self.slow_every == 0 else self.fast
+
+    def __call__(self, name, messages, stream=False):
+        delay = self.delay(name)
+        if not stream:
+            time.sleep(delay)
+            return f"ответ {name}"
+        def chunks():
+            time.sleep(delay)
+            yield "ответ "
+            yield name
+        return chunks()
+
+
+def test_hedging_cuts_tail_latency():
+    providers = FakeProviders()
+    single = bot.ProviderPool(("a",), providers, bot.Metrics(), timeout=2)
+    pooled = bot.ProviderPool(("a", "b"), providers, bot.Metrics(), timeout=2)
+    for pool in (single, pooled):
+        for name in pool.names:
+            pool.latencies[name].extend([providers.fast] * 10)
+    latencies = {}
+    for label, pool in (("single", single), ("pooled", pooled)):
+        samples = []
+        for _ in range(60):
+            start = time.monotonic()
+            assert pool.complete([{"role": "user", "content": "?"}])
+            samples.append(time.monotonic() - start)
+        latencies[label] = (percentile(samples, 0.5), percentile(samples, 0.99))
+    print(f"p50/p99 один провайдер: {latencies['single']}, пул с хеджированием: {latencies['pooled']}")
+    assert latencies["single"][1] >= 1.0
+    assert latencies["pooled"][1] < 0.3
+
+
+def test_stream_hedges_late_first_chunk():
+    pool = bot.ProviderPool(("a", "b"), FakeProviders(slow_every=10 ** 9, lagging={"a"}), bot.Metrics(), timeout=3)
+    pool.latencies["a"].extend([0.01] * 10)
+    pool.latencies["b"].extend([0.05] * 10)
+    start = time.monotonic()
+    text = "".join(pool.stream([{"role": "user", "content": "?"}]))
+    assert text == "ответ b"
+    assert time.monotonic() - start < 0.5
+
+
+def test_stream_falls_over_to_backup_on_failure():
+    pool = bot.ProviderPool(("a", "b"), FakeProviders(broken={"a"}), bot.Metrics(), timeout=2)
+    assert "".join(pool.stream([{"role": "user", "content": "?"}])) == "ответ b"
+
+
+def test_circuit_breaker_skips_failing_provider():
+    pool = bot.ProviderPool(("a", "b"), FakeProviders(broken={"a"}), bot.Metrics(), timeout=2, failure_threshold=3)
+    for _ in range(5):
+        assert pool.complete([{"role": "user", "content": "?"}]) == "ответ b"
+    assert pool.state("a") == "open"
+    assert pool.ranked() == ["b"]
+
+
+def test_streamed_answer_falls_back_to_rules_when_providers_fail(make_bot):
+    failing = FakeProviders(broken={"auto"})
+    instance = make_bot(ai_backend=failing)
+    instance.ai_users.add(7)
+    instance.stream_ai_response(7, "Что такое пункт 1?")
+    assert instance.metrics.total("ai_errors_total") == 1
+    assert instance.vk_session.calls["messages.send"] == 1
@@ -0,0 +1,101 @@
+import os
+import threading
+
+import pytest
+
+import bot
+
+RULES_PATH = os.path.join(os.path.dirname(__file__), "fixtures", "rules.txt")
+
+QUERIES = [
+    ("Можно ли играть с читами и макросами?", "3.1"),
+    ("Нашёл баг на сервере, что делать?", "3.2"),
+    ("Игрок разрушил мою постройку в привате", "3.3"),
+    ("Как вернуть деньги за донат?", "4.2"),
+    ("Хочу сменить никнейм", "5.2"),
+    ("Как обжаловать блокировку?", "6.2"),
+    ("Модератор выдал предметы другу", "7.3"),
+    ("Меня оскорбляют в чате", "2.1"),
+    ("Кто-то рекламирует другой сервер", "2.3"),
+    ("Можно ли передать привилегии на другой аккаунт?", "4.3"),
+    ("Что будет за повторное нарушение?", "6.3"),
+    ("Можно ли продать аккаунт другу?", "5.3"),
+]
+
+
+def approx_tokens(text):
+    return len(text) // 4
+
+
+@pytest.fixture
+def rules_text():
+    with open(RULES_PATH, encoding="utf-8") as f:
+        return f.read()
+
+
+@pytest.fixture
+def index(rules_text):
+    rules = bot.RulesIndex()
+    rules.build(rules_text)
+    return rules
+
+
+def test_parses_numbered_sections(index):
+    assert len(index.sections) == 32
+    assert index.sections["3.1"].startswith("3.1 Запрещено использование читов")
+    assert index.sections["3.1"].endswith("Наказание:\n30 дней блокировки, при повторе — навсегда.")
+    assert "30" not in index.sections
+
+
+def test_body_lines_starting_with_a_number_stay_in_their_section():
+    sections = bot.RulesIndex.parse("3.1 Запрещены читы.\nНаказание:\n7 дней блокировки.\n4) Торговля\n4.1. Продажа запрещена.")
+    assert list(sections) == ["3.1", "4", "4.1"]
+    assert sections["3.1"] == "3.1 Запрещены читы.\nНаказание:\n7 дней блокировки."
+
+
+def test_retrieval_accuracy(index):
+    hits = [expected in index.search(query, 4) for query, expected in QUERIES]
+    print(f"точность top-4: {sum(hits)}/{len(hits)}")
+    assert sum(hits) / len(hits) >= 0.9
+
+
+def test_cited_points_are_always_included(index):
+    assert index.search("Что написано в пункте 4.1?", 2)[0] == "4.1"
+    assert index.search("Почему меня забанили по п. 3.5 и 6.3?", 1) == ["3.5", "6.3"]
+
+
+def test_prompt_holds_only_relevant_sections(make_bot, rules_text):
+    instance = make_bot()
+    instance.rules_index.build(rules_text)
+    messages = instance.prepare_ai_messages(5, "Как обжаловать блокировку?")
+    assert len(messages) == 2
+    prompt = messages[0]["content"]
+    full = instance.catalog.prompt(rules_text)
+    print(f"токенов в промпте: {approx_tokens(prompt)} против {approx_tokens(full)} со всеми правилами")
+    assert "6.2 Обжаловать блокировку" in prompt
+    assert "3.3" not in prompt
+    assert approx_tokens(prompt) - approx_tokens(instance.catalog.prompt("")) <= approx_tokens(rules_text) // 4
+
+
+def test_search_during_rebuild(index, rules_text):
+    errors = []
+    stop = threading.Event()
+
+    def rebuild():
+        variants = [rules_text, rules_text.replace("3.1", "3.9"), "1. Единственное правило"]
+        i = 0
+        while not stop.is_set():
+            index.build(variants[i % len(variants)])
+            i += 1
+
+    thread = threading.Thread(target=rebuild)
+    thread.start()
+    try:
+        for _ in range(3000):
+            index.render(index.search("Можно ли играть с читами?", 4))
+    except Exception as e:
+        errors.append(e)
+    finally:
+        stop.set()
+        thread.join()
+    assert not errors
@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+import vk_api
+
+import bot
+
+
+class FakeExecute:
+    def __init__(self, failures=None):
+        self.batches = []
+        self.failures = failures or {}
+        self.lock = threading.Lock()
+
+    def execute_batch(self, calls):
+        with self.lock:
+            self.batches.append((time.monotonic(), calls))
+        results = []
+        for method, params in calls:
+            codes = self.failures.get(params.get("n"))
+            if codes:
+                results.append((False, {"error_code": codes.pop(0), "error_msg": "fake error"}))
+            else:
+                results.append((True, params.get("n")))
+        return results
+
+
+def test_calls_are_batched_up_to_execute_limit():
+    fake = FakeExecute()
+    sender = bot.SendQueue(fake, rps=5)
+    futures = [sender.call("messages.send", {"n": n}, wait=False) for n in range(60)]
+    assert [future.result(timeout=5) for future in futures] == list(range(60))
+    sizes = [len(calls) for _, calls in fake.batches]
+    assert sum(sizes) == 60 and max(sizes) == sender.BATCH_SIZE and len(sizes) <= 4
+    assert sender.http_calls == len(sizes)
+
+
+def test_batches_are_paced_to_rps():
+    fake = FakeExecute()
+    sender = bot.SendQueue(fake, rps=20)
+    for n in range(8):
+        sender.call("messages.send", {"n": n})
+    gaps = [b[0] - a[0] for a, b in zip(fake.batches, fake.batches[1:])]
+    assert len(gaps) == 7
+    assert min(gaps) >= sender.interval * 0.9
+
+
+@pytest.mark.parametrize("code", sorted(bot.SendQueue.RETRY_CODES))
+def test_rate_limit_codes_are_retried_with_backoff(code):
+    fake = FakeExecute({1: [code, code]})
+    sender = bot.SendQueue(fake, rps=1000, backoff=0.05)
+    started = time.monotonic()
+    assert sender.call("messages.send", {"n": 1}) == 1
+    assert time.monotonic() - started >= 0.05 + 0.1
+    assert len(fake.batches) == 3
+
+
+def test_errors_are_delivered_to_their_own_call():
+    fake = FakeExecute({2: [100], 3: [6, 6, 6, 6]})
+    sender = bot.SendQueue(fake, rps=1000, retries=2, backoff=0.01)
+    futures = [sender.call("messages.send", {"n": n}, wait=False) for n in range(5)]
+    assert futures[0].result(timeout=5) == 0 and futures[4].result(timeout=5) == 4
+    with pytest.raises(vk_api.exceptions.ApiError) as failed:
+        futures[2].result(timeout=5)
+    assert failed.value.code == 100
+    with pytest.raises(vk_api.exceptions.ApiError) as exhausted:
+        futures[3].result(timeout=5)
+    assert exhausted.value.code == 6
+    assert sender.metrics.total("vk_api_errors_total") == 4
+
+
+def test_whole_execute_error_is_retried():
+    class Flaky(FakeExecute):
+        def execute_batch(self, calls):
+            if not self.batches:
+                self.batches.append((time.monotonic(), calls))
+                raise vk_api.exceptions.ApiError(self, "execute", {}, None, {"error_code": 6, "error_msg": "Too many requests"})
+            return super().execute_batch(calls)
+
+    sender = bot.SendQueue(Flaky(), rps=1000, backoff=0.01)
+    assert sender.call("messages.send", {"n": 7}) == 7
+
+
+def test_http_calls_per_thousand_replies(fake_vk):
+    session = fake_vk.session()
+    started = time.perf_counter()
+    for user in range(1000):
+        session.method("messages.send", {"user_id": user, "message": "ответ", "random_id": user})
+    direct = dict(fake_vk.requests), time.perf_counter() - started
+
+    fake_vk.requests.clear()
+    sender = bot.SendQueue(session, rps=20)
+    started = time.perf_counter()
+    futures = [sender.call("messages.send", {"user_id": user, "message": "ответ", "random_id": user}, wait=False) for user in range(1000)]
+    assert all(isinstance(future.result(timeout=30), int) for future in futures)
+    queued = dict(fake_vk.requests), time.perf_counter() - started
+    print(f"HTTP-запросов на 1000 ответов: напрямую {sum(direct[0].values())} за {direct[1]:.2f}с, "
+          f"через SendQueue {sum(queued[0].values())} за {queued[1]:.2f}с ({queued[0]})")
+    assert sum(direct[0].values()) == 1000
+    assert set(queued[0]) == {"execute"} and queued[0]["execute"] <= 41
@@ -0,0 +1,112 @@
+import sys
+import time
+
+import pytest
+
+import bot
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class NullStore(bot.StateStore):
+    def _get(self, namespace, key, default):
+        return default
+
+    def _load(self, namespace):
+        return {}
+
+    def _write(self, batch):
+        pass
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = bot.JournalStateStore(str(tmp_path / "state.json"))
+    yield store
+    store.close()
+
+
+def test_sessions_are_evicted_by_size(store):
+    sessions = bot.SessionStore(store, max_size=3)
+    for user in range(1, 6):
+        sessions.get(user).context = [user]
+    sessions.get(3)
+    sessions.get(6)
+    assert list(sessions.sessions) == [5, 3, 6]
+    assert (sessions.created, sessions.evicted) == (6, 3)
+
+
+def test_idle_sessions_are_evicted_and_reloaded(store, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot.time, "time", clock)
+    sessions = bot.SessionStore(store, idle_ttl=60)
+    sessions.get(1)
+    store.put("contexts", 2, [{"role": "user", "content": "привет"}])
+    sessions.get(2)
+    clock.now += 30
+    sessions.get(2)
+    clock.now += 45
+    sessions.get(3)
+    assert list(sessions.sessions) == [2, 3]
+    clock.now += 61
+    sessions.get(4)
+    assert list(sessions.sessions) == [4]
+    assert sessions.get(2).context == [{"role": "user", "content": "привет"}]
+
+
+@pytest.mark.parametrize("count", [1000, 100000])
+def test_hyperloglog_accuracy(count):
+    hll = bot.HyperLogLog()
+    for user in range(count):
+        hll.add(user)
+        hll.add(user)
+    assert abs(len(hll) - count) / count < 0.05
+
+
+def test_hyperloglog_merge_counts_union():
+    first, second = bot.HyperLogLog(), bot.HyperLogLog()
+    for user in range(0, 60000):
+        first.add(user)
+    for user in range(40000, 100000):
+        second.add(user)
+    restored = bot.HyperLogLog(registers=bytes.fromhex(first.registers.hex()))
+    restored.merge(second.registers)
+    assert abs(len(restored) - 100000) / 100000 < 0.05
+
+
+def footprint(sessions):
+    size = sys.getsizeof(sessions.sessions)
+    for session in sessions.sessions.values():
+        size += sys.getsizeof(session) + sys.getsizeof(session.buckets) + sys.getsizeof(session.context)
+        size += sum(sys.getsizeof(message) for message in session.context)
+    return size
+
+
+def test_memory_stays_bounded_with_1m_users():
+    store = NullStore()
+    sessions = bot.SessionStore(store, max_size=100000)
+    users = bot.HyperLogLog()
+    started = time.perf_counter()
+    try:
+        for user in range(1000000):
+            sessions.get(user).context = [{"role": "user", "content": "Как получить разбан?"}]
+            users.add(user)
+            if user == 100000:
+                at_limit = footprint(sessions)
+    finally:
+        store.close()
+    elapsed = time.perf_counter() - started
+    final = footprint(sessions)
+    unique = set(range(1000000))
+    print(f"1M пользователей за {elapsed:.1f}с: сессий {len(sessions)}, вытеснено {sessions.evicted}, "
+          f"сессии {final / 2 ** 20:.0f} МБ (на пределе {at_limit / 2 ** 20:.0f} МБ), "
+          f"HLL {len(users.registers) // 1024} КБ против {sys.getsizeof(unique) // 2 ** 20} МБ у множества, уникальных {len(users)}")
+    assert len(sessions) == 100000 and sessions.evicted == 900000
+    assert final < at_limit * 1.25
+    assert abs(len(users) - 1000000) / 1000000 < 0.05
@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+
+import bot
+
+
+def test_send_budget_is_split_across_shards(make_bot):
+    shards = [make_bot(shard=i, shards=3) for i in range(3)]
+    assert sum(instance.outbox.rps for instance in shards) == bot.SupportBot.SEND_RPS
+
+
+def test_active_segment_reads_all_shards(make_bot):
+    first, second = make_bot(shard=0, shards=2), make_bot(shard=1, shards=2)
+    first.ai_users.add(2)
+    second.human_users.add(3)
+    second.store.flush()
+    assert first.broadcast_audience("#active") == [2, 3]
+
+
+def test_atomic_write_is_safe_for_concurrent_writers(tmp_path):
+    path = str(tmp_path / "agents.json")
+    errors = []
+
+    def write(value):
+        try:
+            for _ in range(50):
+                bot.atomic_write(path, value)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(str(i) * 100,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert len(open(path, encoding="utf-8").read()) == 100
+    assert [p.name for p in tmp_path.iterdir()] == ["agents.json"]
+
+
+def test_only_owning_shard_persists_ban_expiry(make_bot):
+    first, second = make_bot(shard=0, shards=2), make_bot(shard=1, shards=2)
+    second.banned.history[3] = [{"from": 0, "until": 1, "by": 10}]
+    second.store.flush()
+    assert first.banned.ban(3, 0.0003, by=10)
+    first.store.flush()
+    second.banned.apply_ban(3, first.banned.bans[3])
+    deadline = time.time() + 5
+    while (3 in first.banned.bans or 3 in second.banned.bans) and time.time() < deadline:
+        time.sleep(0.05)
+    first.store.flush()
+    second.store.flush()
+    history = first.store.get("ban_history", 3)
+    assert len(history) == 2
+    assert "lifted" in history[-1]
+
+
+def wait_for(condition, timeout):
+    started = time.monotonic()
+    while not condition():
+        assert time.monotonic() - started < timeout
+        time.sleep(0.01)
+    return time.monotonic() - started
+
+
+def test_ban_and_agents_reach_other_shard_within_sync_interval(make_bot, monkeypatch):
+    monkeypatch.setattr(bot.SupportBot, "SYNC_INTERVAL", 0.2)
+    first, second = make_bot(shard=0, shards=2), make_bot(shard=1, shards=2)
+    threading.Thread(target=second.sync_shards, daemon=True).start()
+    time.sleep(0.05)
+    first.agents["2"] = {"role": "manager"}
+    first.banned.ban(5, 1, by=2)
+    banned = wait_for(lambda: second.banned.is_banned(5), 2 * bot.SupportBot.SYNC_INTERVAL)
+    first.process_action(2, "add_agent", "7 agent")
+    added = wait_for(lambda: "7" in second.agents, 2 * bot.SupportBot.SYNC_INTERVAL)
+    print(f"ban дошёл до другого шарда за {banned:.2f}с, add_agent за {added:.2f}с при SYNC_INTERVAL {bot.SupportBot.SYNC_INTERVAL}с")
+    assert second.agents["7"]["role"] == "agent"
+
+
+def test_sharded_throughput(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    events = [event for event in bot.synthetic_events(3000, users=2000) if event.user_id != 1]
+    rates = {}
+    for shards in sorted({1, 2, max(2, min(os.cpu_count() or 1, 4))}):
+        monkeypatch.setattr(bot.SupportBot, "STATE_PATH", str(tmp_path / f"state-{shards}.db"))
+        rates[shards] = bot.SupportBot.run_sharded(None, 2, 1, shards, iter(events))
+        store = bot.SqliteStateStore(bot.SupportBot.STATE_PATH)
+        stats = store.load("stats")
+        store.close()
+        processed = sum(stats.get("messages" if shards == 1 else f"messages:{shard}", 0) for shard in range(shards))
+        assert processed == len(events)
+    print(f"ядер: {os.cpu_count()}, событий/с по числу шардов: " + ", ".join(f"{shards}: {rate:.0f}" for shards, rate in rates.items()))
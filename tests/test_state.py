@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+import bot
+
+
+def test_journal_recovers_after_torn_record(tmp_path):
+    path = str(tmp_path / "state.json")
+    store = bot.JournalStateStore(path)
+    store.put("bans", "1", 100)
+    store.close()
+    with open(path + ".journal", "a", encoding="utf-8") as f:
+        f.write('["bans", "2", 2')
+    store = bot.JournalStateStore(path)
+    store.put("bans", "3", 300)
+    store.close()
+    store = bot.JournalStateStore(path)
+    assert store.load("bans") == {"1": 100, "3": 300}
+    store.close()
+
+
+
+def test_state_store_requires_backend_methods():
+    with pytest.raises(TypeError):
+        bot.StateStore()
+
+
+STORES = {
+    "sqlite": lambda path: bot.SqliteStateStore(str(path / "state.db")),
+    "journal": lambda path: bot.JournalStateStore(str(path / "state.json")),
+}
+
+
+@pytest.mark.parametrize("backend", sorted(STORES))
+def test_write_overhead_and_recovery_with_100k_users(tmp_path, backend):
+    users = 100000
+    store = STORES[backend](tmp_path)
+    started = time.perf_counter()
+    for user in range(users):
+        store.put("contexts", user, [{"role": "user", "content": "Как получить разбан?"}, {"role": "assistant", "content": "Через поддержку."}])
+        store.put("users", user, 1700000000 + user)
+        if user % 20 == 0:
+            store.put("bans", user, "2030-01-01T00:00:00")
+    put_time = time.perf_counter() - started
+    started = time.perf_counter()
+    store.close()
+    flush_time = time.perf_counter() - started
+    events = users * 2 + users // 20
+
+    started = time.perf_counter()
+    store = STORES[backend](tmp_path)
+    bans = bot.BanRegistry(store)
+    session = bot.SessionStore(store).get(users - 1)
+    recovery = time.perf_counter() - started
+    print(f"{backend}: запись {put_time / events * 1e6:.1f} мкс/событие в потоке бота, "
+          f"сброс {flush_time / events * 1e6:.1f} мкс/запись в фоне, восстановление {recovery:.2f}с")
+    assert len(bans) == users // 20 and bans.is_banned(0)
+    assert session.context[-1]["content"] == "Через поддержку."
+    assert put_time / events < 50e-6
+    assert recovery < 5
+    store.close()
@@ -0,0 +1,43 @@
+import functools
+import time
+
+import bot
+
+BACKEND = functools.partial(bot.offline_ai, delay=0.1, chunk_delay=0.05)
+
+
+class TimedVk(bot.OfflineVk):
+    def __init__(self):
+        super().__init__()
+        self.sends = []
+        self.edits = []
+
+    def method(self, method, values=None):
+        if method == "messages.send":
+            self.sends.append(time.monotonic())
+        elif method == "messages.edit":
+            self.edits.append(time.monotonic())
+        return super().method(method, values)
+
+
+def test_streaming_cuts_time_to_first_byte(make_bot):
+    vk = TimedVk()
+    instance = make_bot(ai_backend=BACKEND, vk_session=vk)
+    instance.STREAM_EDIT_INTERVAL = 0.1
+
+    started = time.monotonic()
+    instance.send_message(7, instance.get_ai_response(7, "Как получить разбан?"))
+    blocking = vk.sends[0] - started
+
+    vk.sends.clear()
+    started = time.monotonic()
+    instance.stream_ai_response(8, "Как получить разбан?")
+    streaming = vk.sends[0] - started
+    print(f"TTFB: потоковый {streaming:.3f}с, блокирующий {blocking:.3f}с")
+
+    assert len(vk.sends) == 1
+    assert streaming < blocking / 2
+    assert vk.edits
+    gaps = [b - a for a, b in zip([vk.sends[0]] + vk.edits[:-1], vk.edits[:-1])]
+    assert all(gap >= instance.STREAM_EDIT_INTERVAL for gap in gaps)
+    assert len(vk.edits) <= (vk.edits[-1] - vk.sends[0]) / instance.STREAM_EDIT_INTERVAL + 1
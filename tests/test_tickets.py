@@ -0,0 +1,127 @@
+import time
+
+import pytest
+
+from conftest import event
+
+import bot
+
+
+def test_bot_echo_is_not_first_response(offline_bot):
+    offline_bot.contact_agent(9)
+    echo = offline_bot.vk_session.message_id
+    offline_bot.process_message(event(9, "Связь с оператором", to_me=False, message_id=echo))
+    assert offline_bot.tickets.get(9)["first_response"] is None
+    offline_bot.process_message(event(9, "Здравствуйте!", to_me=False, message_id=echo + 1000))
+    assert offline_bot.tickets.get(9)["first_response"] is not None
+
+
+def test_callback_reply_counts_only_with_admin_author(offline_bot):
+    offline_bot.contact_agent(9)
+    reply = {"type": "message_reply", "object": {"peer_id": 9, "from_id": -1, "id": 500, "text": "ok"}}
+    offline_bot.process_message(bot.CallbackServer.to_event(reply))
+    assert offline_bot.tickets.get(9)["first_response"] is None
+    reply["object"]["admin_author_id"] = 77
+    offline_bot.process_message(bot.CallbackServer.to_event(reply))
+    assert offline_bot.tickets.get(9)["first_response"] is not None
+
+
+def test_end_ai_closes_ticket(offline_bot):
+    offline_bot.contact_agent(9)
+    offline_bot.process_command(9, "end_ai")
+    assert offline_bot.tickets.get(9) is None
+    assert 9 not in offline_bot.human_users
+
+
+def test_ticket_ids_are_unique_across_shards(make_bot):
+    first, second = make_bot(shard=0, shards=2), make_bot(shard=1, shards=2)
+    ids = {first.tickets.open(user)[0]["id"] for user in (2, 4, 6)} | {second.tickets.open(user)[0]["id"] for user in (1, 3, 5)}
+    assert len(ids) == 6
+
+
+def test_tickets_and_close_are_served_from_store_when_sharded(make_bot):
+    first, second = make_bot(shard=0, shards=2), make_bot(shard=1, shards=2)
+    second.agents["10"] = {"role": "agent"}
+    first.agents["10"] = {"role": "agent"}
+    second.contact_agent(3)
+    second.store.flush()
+    tickets, count, _ = first.tickets.snapshot()
+    assert count == 1 and tickets[0]["user"] == 3
+    first.process_command(10, "close 3")
+    changes = second.store.changes(0)
+    assert changes[-1][2] == "close_ticket"
+    second.close_ticket(10, 3)
+    assert second.tickets.get(3) is None
+
+
+def test_assignment_prefers_agents_then_balances_load(offline_bot):
+    offline_bot.agents.update({"10": {"role": "manager"}, "11": {"role": "agent"}, "12": {"role": "agent"}})
+    assignees = [offline_bot.tickets.open(user)[0]["assignee"] for user in range(100, 104)]
+    assert sorted(assignees) == ["11", "11", "12", "12"]
+
+
+def test_shard_indexes_only_its_own_tickets(make_bot):
+    second = make_bot(shard=1, shards=2)
+    second.tickets.open(3)
+    second.store.flush()
+    first = make_bot(shard=0, shards=2)
+    second.tickets.close(3)
+    ticket, _ = first.tickets.open(2)
+    assert first.tickets.waiting == [ticket["id"]]
+    assert first.tickets.position(ticket) == 1
+    assert first.metrics.render().count("tickets_open 1") == 1
+
+
+def test_sharded_load_and_lookup_use_store_counters(make_bot):
+    first, second = make_bot(shard=0, shards=2), make_bot(shard=1, shards=2)
+    for instance in (first, second):
+        instance.agents.update({"10": {"role": "agent"}, "11": {"role": "agent"}})
+    assignees = [first.tickets.open(2)[0]["assignee"], second.tickets.open(3)[0]["assignee"], first.tickets.open(4)[0]["assignee"]]
+    assert sorted(assignees) == ["10", "10", "11"]
+    second.store.flush()
+    assert first.tickets.find(3)["user"] == 3
+    second.tickets.close(3)
+    second.store.flush()
+    assert first.tickets.find(3) is None
+    assert first.tickets.assigned("10") + first.tickets.assigned("11") == 2
+    assert first.tickets.snapshot()[1] == 2
+
+
+def queue_timings(tickets, users):
+    started = time.perf_counter()
+    opened = [tickets.open(user)[0] for user in users]
+    open_time = time.perf_counter() - started
+    started = time.perf_counter()
+    for ticket in opened:
+        tickets.position(ticket)
+    position_time = time.perf_counter() - started
+    started = time.perf_counter()
+    for user in users:
+        tickets.respond(user)
+    respond_time = time.perf_counter() - started
+    started = time.perf_counter()
+    for user in users:
+        tickets.find(user)
+        tickets.close(user)
+    close_time = time.perf_counter() - started
+    return [t / len(users) * 1e6 for t in (open_time, position_time, respond_time, close_time)]
+
+
+@pytest.mark.parametrize("shards", [1, 2])
+def test_queue_operations_stay_flat_with_thousands_of_open_tickets(make_bot, shards):
+    instance = make_bot(shard=0, shards=shards)
+    instance.agents.update({str(uid): {"role": "agent"} for uid in range(10, 20)})
+    results = {}
+    for backlog in (100, 5000):
+        base = 100000 * shards
+        for user in range(base, base + backlog * shards, shards):
+            instance.tickets.open(user)
+        instance.store.flush()
+        probe = range(base * 10, base * 10 + 200 * shards, shards)
+        results[backlog] = queue_timings(instance.tickets, probe)
+        for user in range(base, base + backlog * shards, shards):
+            instance.tickets.close(user)
+        instance.store.flush()
+    print(f"шардов {shards}, мкс на open/position/respond/close: "
+          + ", ".join(f"{backlog} открытых: {'/'.join(f'{t:.0f}' for t in timings)}" for backlog, timings in results.items()))
+    assert sum(results[5000]) < sum(results[100]) * 3